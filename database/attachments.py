@@ -7,8 +7,7 @@ from typing import Dict, List, Optional, Sequence
 from database.singleton import Database
 
 
-ATTACHMENT_COLUMNS = """
-    SELECT
+ATTACHMENT_FIELDS = """\
         id,
         chat_id,
         message_id,
@@ -17,10 +16,29 @@ ATTACHMENT_COLUMNS = """
         mime_type,
         size_bytes,
         created_at,
-        original_name
+        original_name"""
+
+ATTACHMENT_COLUMNS = f"""
+    SELECT
+{ATTACHMENT_FIELDS}
     FROM attachments
 """
 
+INSERT_ATTACHMENT_QUERY = f"""
+    INSERT INTO attachments (
+        chat_id,
+        message_id,
+        sender_id,
+        file_name,
+        mime_type,
+        size_bytes,
+        original_name
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    RETURNING
+{ATTACHMENT_FIELDS}
+"""
+
 
 def create_attachment_record(
     db: Database,
@@ -33,20 +51,8 @@ def create_attachment_record(
     size_bytes: int | None,
     original_name: str,
 ) -> dict:
-    insert_query = """
-        INSERT INTO attachments (
-            chat_id,
-            message_id,
-            sender_id,
-            file_name,
-            mime_type,
-            size_bytes,
-            original_name
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """
-    db.execute_query(
-        insert_query,
+    rows = db.execute_returning(
+        INSERT_ATTACHMENT_QUERY,
         (
             chat_id,
             message_id,
@@ -57,39 +63,43 @@ def create_attachment_record(
             original_name,
         ),
     )
-    rows = db.fetch_query(
-        ATTACHMENT_COLUMNS
-        + """
-        WHERE id = last_insert_rowid()
-        """
-    )
     if not rows:
         raise RuntimeError("No se pudo registrar el adjunto en la base de datos.")
     return rows[0]
 
 
-def fetch_attachment_by_id(db: Database, attachment_id: int) -> Optional[dict]:
-    rows = db.fetch_query(
-        ATTACHMENT_COLUMNS
-        + """
+ATTACHMENT_BY_ID_QUERY = ATTACHMENT_COLUMNS + """
         WHERE id = ?
-        """,
-        (attachment_id,),
-    )
+        """
+
+CHAT_ATTACHMENTS_QUERY = ATTACHMENT_COLUMNS + """
+        WHERE chat_id = ?
+        ORDER BY created_at DESC, id DESC
+        """
+
+# Tamaños fijos de la lista IN (...) para que solo existan unas pocas formas
+# de la consulta y todas se reutilicen desde la caché de sentencias.
+MESSAGE_ID_BATCH_SIZES = (1, 8, 64, 512)
+
+ATTACHMENTS_BY_MESSAGE_IDS_QUERIES = {
+    size: ATTACHMENT_COLUMNS
+    + f"""
+        WHERE message_id IN ({",".join("?" * size)})
+        ORDER BY created_at ASC, id ASC
+        """
+    for size in MESSAGE_ID_BATCH_SIZES
+}
+
+
+def fetch_attachment_by_id(db: Database, attachment_id: int) -> Optional[dict]:
+    rows = db.fetch_query(ATTACHMENT_BY_ID_QUERY, (attachment_id,))
     if not rows:
         return None
     return rows[0]
 
 
 def fetch_chat_attachments(db: Database, chat_id: int) -> List[dict]:
-    rows = db.fetch_query(
-        ATTACHMENT_COLUMNS
-        + """
-        WHERE chat_id = ?
-        ORDER BY created_at DESC, id DESC
-        """,
-        (chat_id,),
-    )
+    rows = db.fetch_query(CHAT_ATTACHMENTS_QUERY, (chat_id,))
     return rows or []
 
 
@@ -98,31 +108,38 @@ def fetch_attachments_by_message_ids(
 ) -> Dict[int, List[dict]]:
     if not message_ids:
         return {}
-    placeholders = ",".join("?" for _ in message_ids)
-    rows = db.fetch_query(
-        ATTACHMENT_COLUMNS
-        + f"""
-        WHERE message_id IN ({placeholders})
-        ORDER BY created_at ASC, id ASC
-        """,
-        tuple(message_ids),
-    )
+    unique_ids = list(dict.fromkeys(message_ids))
+    max_batch = MESSAGE_ID_BATCH_SIZES[-1]
     grouped: Dict[int, List[dict]] = {}
-    for row in rows or []:
-        grouped.setdefault(row["message_id"], []).append(row)
+    for start in range(0, len(unique_ids), max_batch):
+        batch = unique_ids[start:start + max_batch]
+        size = next(size for size in MESSAGE_ID_BATCH_SIZES if size >= len(batch))
+        # Se rellena repitiendo el último id; IN ignora los duplicados.
+        params = tuple(batch) + (batch[-1],) * (size - len(batch))
+        rows = db.fetch_query(ATTACHMENTS_BY_MESSAGE_IDS_QUERIES[size], params)
+        for row in rows or []:
+            grouped.setdefault(row["message_id"], []).append(row)
     return grouped
 
 
+def hydrate_message_attachments(db: Database, messages: List[dict]) -> List[dict]:
+    """
+    Agrega la lista serializada de adjuntos a cada mensaje usando una sola
+    consulta por lote de ids, en lugar de una consulta por mensaje.
+    """
+    if not messages:
+        return messages
+    attachments_map = fetch_attachments_by_message_ids(
+        db, [message["message_id"] for message in messages]
+    )
+    for message in messages:
+        attachments = attachments_map.get(message["message_id"], [])
+        message["attachments"] = [serialize_attachment(item) for item in attachments]
+    return messages
+
+
 def serialize_attachment(row: dict) -> dict:
-    return {
-        "id": row["id"],
-        "chat_id": row["chat_id"],
-        "message_id": row["message_id"],
-        "sender_id": row["sender_id"],
-        "file_name": row["file_name"],
-        "mime_type": row["mime_type"],
-        "size_bytes": row["size_bytes"],
-        "created_at": row["created_at"],
-        "original_name": row.get("original_name"),
-        "download_url": f"/files/attachments/{row['id']}/download",
-    }
+    # Las filas ya traen exactamente las columnas públicas del adjunto;
+    # solo se agrega la URL de descarga sobre el mismo diccionario.
+    row["download_url"] = f"/files/attachments/{row['id']}/download"
+    return row
@@ -0,0 +1,122 @@
+"""Índices y cambios de esquema que se aplican al arrancar el servidor."""
+
+from __future__ import annotations
+
+from database.singleton import Database
+
+
+# chat_members(chat_id, user_id) no se declara: la llave primaria de la tabla
+# ya es ese índice y lo usa la verificación de membresía.
+HOT_PATH_INDEXES = (
+    # Chats de un usuario (/chats/my_chats).
+    """
+    CREATE INDEX IF NOT EXISTS idx_chat_members_user
+    ON chat_members(user_id, chat_id)
+    """,
+    # Paginación de mensajes por chat en orden cronológico.
+    """
+    CREATE INDEX IF NOT EXISTS idx_messages_chat_created
+    ON messages(chat_id, created_at DESC, message_id)
+    """,
+    # Adjuntos de una página de mensajes (message_id IN (...)).
+    """
+    CREATE INDEX IF NOT EXISTS idx_attachments_message
+    ON attachments(message_id, created_at, id)
+    """,
+    # Listado de adjuntos de un chat.
+    """
+    CREATE INDEX IF NOT EXISTS idx_attachments_chat
+    ON attachments(chat_id, created_at DESC, id)
+    """,
+    # Login y búsqueda exacta por username. Si ya existen usernames
+    # duplicados la creación falla y se registra el error sin detener
+    # el arranque.
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username
+    ON Usuarios(username)
+    """,
+)
+
+
+# Columnas agregadas después de crear las tablas: (tabla, columna, tipo).
+ADDED_COLUMNS = (
+    # Tipo MIME del avatar, calculado una vez al subirlo.
+    ("Usuarios", "profile_image_mime", "TEXT"),
+)
+
+
+def ensure_columns(db: Database) -> None:
+    """
+    Agrega con ALTER TABLE las columnas de ADDED_COLUMNS que todavía no
+    existan en la base de datos.
+    """
+    for table, column, column_type in ADDED_COLUMNS:
+        existing = db.fetch_query(f"PRAGMA table_info({table})") or []
+        if any(row["name"] == column for row in existing):
+            continue
+        db.execute_query(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def ensure_indexes(db: Database) -> None:
+    """
+    Crea (si no existen) los índices de HOT_PATH_INDEXES y actualiza las
+    estadísticas del planificador con ANALYZE.
+    """
+    for statement in HOT_PATH_INDEXES:
+        db.execute_query(statement)
+    db.execute_query("ANALYZE")
+
+
+# Índice de texto completo (FTS5 con tokenizador trigram) sobre
+# Usuarios.username. Con trigram, `username LIKE '%term%'` se resuelve con el
+# índice en lugar de recorrer toda la tabla. Es una tabla de contenido
+# externo: los triggers la mantienen sincronizada con Usuarios.
+USER_SEARCH_TABLE = "Usuarios_fts"
+
+USER_SEARCH_STATEMENTS = (
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {USER_SEARCH_TABLE} USING fts5(
+        username,
+        content='Usuarios',
+        content_rowid='Id_Usuarios',
+        tokenize='trigram'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {USER_SEARCH_TABLE}_ai AFTER INSERT ON Usuarios BEGIN
+        INSERT INTO {USER_SEARCH_TABLE}(rowid, username)
+        VALUES (new.Id_Usuarios, new.username);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {USER_SEARCH_TABLE}_ad AFTER DELETE ON Usuarios BEGIN
+        INSERT INTO {USER_SEARCH_TABLE}({USER_SEARCH_TABLE}, rowid, username)
+        VALUES ('delete', old.Id_Usuarios, old.username);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {USER_SEARCH_TABLE}_au AFTER UPDATE OF username ON Usuarios BEGIN
+        INSERT INTO {USER_SEARCH_TABLE}({USER_SEARCH_TABLE}, rowid, username)
+        VALUES ('delete', old.Id_Usuarios, old.username);
+        INSERT INTO {USER_SEARCH_TABLE}(rowid, username)
+        VALUES (new.Id_Usuarios, new.username);
+    END
+    """,
+)
+
+
+def ensure_user_search_index(db: Database) -> None:
+    """
+    Crea la tabla FTS5 de búsqueda de usuarios y sus triggers. Si la tabla
+    no existía se llena a partir de Usuarios.
+    """
+    existing = db.fetch_query(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (USER_SEARCH_TABLE,),
+    )
+    for statement in USER_SEARCH_STATEMENTS:
+        db.execute_query(statement)
+    if not existing:
+        db.execute_query(
+            f"INSERT INTO {USER_SEARCH_TABLE}({USER_SEARCH_TABLE}) VALUES ('rebuild')"
+        )
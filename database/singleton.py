@@ -3,12 +3,42 @@
 # Importar librerías
 import sqlite3
 from sqlite3 import Error
-from typing import Any, List, Tuple, Optional
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Tuple, Optional
+import logging
 import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# PRAGMAs que se aplican a cada conexión nueva: WAL permite que los lectores
+# avancen mientras otro hilo confirma una escritura y synchronous=NORMAL evita
+# un fsync por cada commit.
+CONNECTION_PRAGMAS: str = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+    PRAGMA mmap_size=268435456;
+    PRAGMA foreign_keys=ON;
+    PRAGMA busy_timeout=5000;
+"""
+
+# Tamaño de la caché de sentencias preparadas de cada conexión (el valor por
+# defecto de sqlite3 es 128). Las consultas se escriben como constantes para
+# que el texto SQL se repita exactamente y reutilice la sentencia preparada.
+STATEMENT_CACHE_SIZE: int = 512
 
 class Database:
+    """
+    Fachada singleton sobre SQLite. Cada hilo que atiende peticiones obtiene
+    su propia conexión (creada la primera vez que la necesita), de modo que
+    las consultas concurrentes no comparten cursor ni se serializan sobre
+    una única conexión.
+    """
 
     _instance = None
+    _instance_lock = threading.Lock()
     # Obtenemos la ruta del directorio don de se encuentra este script
     _file_name: str = "tesisDB.db"
     _base_dir: str = os.path.dirname(__file__)
@@ -17,42 +47,160 @@ class Database:
 
     def __new__(cls):
         if cls._instance is None:
-            try:
-                cls._instance = super(Database, cls).__new__(cls)
-                cls._instance.connection = sqlite3.connect(cls._db_path, check_same_thread=False)
-                # Configuramos el row_factory para que las filas
-                # se puedan convertir en directorios.
-                cls._instance.connection.row_factory = sqlite3.Row
-                cls._instance.cursor = cls._instance.connection.cursor()
-                print(f"Conexión a la base de datos establecida en: {cls._db_path}")
-            except Error as e:
-                print(f"Error al conectar con la base de datos {cls._file_name}, error: \n {e}")
-                cls._instance = None
+            with cls._instance_lock:
+                if cls._instance is None:
+                    instance = super(Database, cls).__new__(cls)
+                    instance._local = threading.local()
+                    instance._connections = []
+                    instance._connections_lock = threading.Lock()
+                    try:
+                        # Abrimos la conexión del hilo actual para validar
+                        # que la base de datos es accesible.
+                        instance.connection
+                        cls._instance = instance
+                        logger.debug("Conexión a la base de datos establecida en: %s", cls._db_path)
+                    except Error as e:
+                        logger.error("Error al conectar con la base de datos %s, error: %s", cls._file_name, e)
         return cls._instance
-    
-    def execute_query(self, query: str, params: Tuple = ()) -> None:
+
+    def _open_connection(self) -> sqlite3.Connection:
+        # check_same_thread=False solo para que close_connection pueda
+        # cerrar desde otro hilo; cada conexión la usa un único hilo.
+        connection = sqlite3.connect(
+            self._db_path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        connection.executescript(CONNECTION_PRAGMAS)
+        with self._connections_lock:
+            self._connections.append(connection)
+        return connection
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # Las filas se leen como tuplas; fetch_query arma los
+        # diccionarios con los nombres de columna del cursor.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._open_connection()
+            self._local.connection = connection
+        return connection
+
+    def _in_transaction(self) -> bool:
+        return getattr(self._local, "in_transaction", False)
+
+    def _commit(self, connection: sqlite3.Connection) -> None:
+        # Dentro de transaction() el commit lo hace el contexto al salir.
+        if not self._in_transaction():
+            connection.commit()
+
+    @contextmanager
+    def transaction(self) -> Iterator["Database"]:
+        """
+        Agrupa varias escrituras del hilo actual en una sola transacción
+        (BEGIN IMMEDIATE ... COMMIT), de modo que se confirman con un único
+        commit. Si ocurre una excepción dentro del bloque se revierte todo;
+        dentro del bloque, execute_query, execute_returning y executemany
+        propagan el sqlite3.Error en lugar de revertir y retornar None.
+        Un transaction() anidado se une a la transacción exterior.
+        """
+        if self._in_transaction():
+            yield self
+            return
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        self._local.in_transaction = True
+        try:
+            yield self
+        except BaseException:
+            connection.rollback()
+            raise
+        else:
+            connection.commit()
+        finally:
+            self._local.in_transaction = False
+
+    @contextmanager
+    def savepoint(self) -> Iterator["Database"]:
+        """
+        Dentro de transaction(), aísla un grupo de escrituras con un
+        SAVEPOINT: si el bloque lanza una excepción solo se revierte lo hecho
+        en él y la transacción exterior sigue viva. Fuera de una transacción
+        equivale a transaction().
+        """
+        if not self._in_transaction():
+            with self.transaction():
+                yield self
+            return
+        connection = self.connection
+        depth = getattr(self._local, "savepoint_depth", 0)
+        name = f"sp_{depth}"
+        connection.execute(f"SAVEPOINT {name}")
+        self._local.savepoint_depth = depth + 1
+        try:
+            yield self
+        except BaseException:
+            connection.execute(f"ROLLBACK TO {name}")
+            connection.execute(f"RELEASE {name}")
+            raise
+        else:
+            connection.execute(f"RELEASE {name}")
+        finally:
+            self._local.savepoint_depth = depth
+
+    def execute_query(self, query: str, params: Tuple = ()) -> Optional[int]:
         # Ejecuta una consulta SQL que no retorna resultados:
         # INSERT, UPDATE, DELETE, etc...
+        # Retorna el rowid de la última fila insertada (cursor.lastrowid)
+        # para no tener que consultar last_insert_rowid() por separado.
+        connection = self.connection
         try: 
-            self.cursor.execute(query, params)
-            self.connection.commit()
-            print(f"Consulta ejecutada exitosamente.")
+            cursor = connection.execute(query, params)
+            self._commit(connection)
+            logger.debug("Consulta ejecutada exitosamente.")
+            return cursor.lastrowid
+        except Error as e:
+            logger.warning("Error al ejecutar la consulta: %s", e)
+            # Dentro de transaction() el error se propaga: un rollback aquí
+            # cancelaría el BEGIN exterior y lo que siga correría en
+            # autocommit. El contexto decide si se revierte todo.
+            if self._in_transaction():
+                raise
+            connection.rollback()
+            return None
+
+    def execute_returning(self, query: str, params: Tuple = ()) -> Optional[List[Any]]:
+        # Ejecuta una escritura con cláusula RETURNING y retorna las filas
+        # producidas, confirmando la transacción en la misma llamada.
+        connection = self.connection
+        try:
+            cursor = connection.execute(query, params)
+            resultados = cursor.fetchall()
+            columns = tuple(column[0] for column in cursor.description or ())
+            self._commit(connection)
+            logger.debug("Consulta con RETURNING ejecutada exitosamente.")
+            return [dict(zip(columns, row)) for row in resultados]
         except Error as e:
-            print(f"Error al ejecutar la consulta: {e}")
-            self.connection.rollback()
+            logger.warning("Error al ejecutar la consulta con RETURNING: %s", e)
+            if self._in_transaction():
+                raise
+            connection.rollback()
+            return None
 
     def fetch_query(self, query: str, params: Tuple = ()) -> Optional[List[Any]]:
         # Ejecuta una consulta SQL que retorna resultados (SELECT)
         # y retorna una lista con los resultados
         try:
-            self.cursor.execute(query, params)
-            resultados = self.cursor.fetchall()
-            # Convertimos cada fila en un diccionario
-            result_list = [dict(row) for row in resultados]
-            print("Consulta de selección ejecutada exitosamente.")
+            cursor = self.connection.execute(query, params)
+            resultados = cursor.fetchall()
+            # Los nombres de columna se obtienen una sola vez por consulta
+            # y se comparten entre todas las filas.
+            columns = tuple(column[0] for column in cursor.description or ())
+            result_list = [dict(zip(columns, row)) for row in resultados]
+            logger.debug("Consulta de selección ejecutada exitosamente.")
             return result_list
         except Error as e:
-            print(f"Error al ejecutar la consulta de selección: {e}")
+            logger.warning("Error al ejecutar la consulta de selección: %s", e)
             return None
 
     # singleton.py  ➜ agrega este método dentro de la clase Database
@@ -61,21 +209,36 @@ class Database:
         Ejecuta la misma consulta SQL con múltiples conjuntos de parámetros
         (útil para inserciones masivas).
         """
+        connection = self.connection
         try:
-            self.cursor.executemany(query, seq_params)
-            self.connection.commit()
-            print("Consulta executemany ejecutada exitosamente.")
+            connection.executemany(query, seq_params)
+            self._commit(connection)
+            logger.debug("Consulta executemany ejecutada exitosamente.")
         except Error as e:
-            print(f"Error en executemany: {e}")
-            self.connection.rollback()
+            logger.warning("Error en executemany: %s", e)
+            if self._in_transaction():
+                raise
+            connection.rollback()
 
 
     def close_connection(self):
-        # Cerramos la conexión a la base de datos.
-        if self.close_connection:
-            self.connection.close()
-            Database._instance = None
-            print("Conexión a la base de datos cerrada")
+        # Cerramos todas las conexiones abiertas por los distintos hilos.
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+        Database._instance = None
+        logger.debug("Conexión a la base de datos cerrada")
+
+
+async def get_db() -> Database:
+    # Dependencia de FastAPI (Depends(get_db)): los endpoints reciben la
+    # base de datos por parámetro y se puede reemplazar con
+    # app.dependency_overrides[get_db] sin tocar los routers. Es async para
+    # que FastAPI la resuelva en el event loop y no en el threadpool; la
+    # conexión de cada hilo se abre al usarla (Database.connection).
+    return Database()
 
 
 
@@ -89,7 +252,6 @@ def file_path(file_name: str) -> str: # file_name debe incluir extención
     base_dir: str = os.path.dirname(__file__)
     # Construir la ruta hacia el archivo
     db_path: str = os.path.join(base_dir, file_name)
-    print(f"La ruta solicitada del archivo {file_name} es: {db_path}")
     return db_path
 
 # FUNCIÓN PARA DETERMINAR LA EXISTENCIA DE ARCHIVO EN FICHERO
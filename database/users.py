@@ -7,31 +7,63 @@ from typing import Optional
 from database.singleton import Database
 
 
+USER_COLUMNS = """
+    SELECT
+        Id_Usuarios AS user_id,
+        username,
+        NombreCompleto AS full_name,
+        email,
+        Foto_perfil AS profile_image,
+        profile_image_mime
+    FROM Usuarios
+"""
+
+USER_BY_ID_QUERY = USER_COLUMNS + """
+    WHERE Id_Usuarios = ?
+    LIMIT 1
+"""
+
+USER_BY_USERNAME_QUERY = USER_COLUMNS + """
+    WHERE LOWER(username) = LOWER(?)
+    LIMIT 1
+"""
+
+PROFILE_IMAGE_BY_ID_QUERY = """
+    SELECT Foto_perfil AS profile_image
+    FROM Usuarios
+    WHERE Id_Usuarios = ?
+"""
+
+UPDATE_PROFILE_IMAGE_QUERY = """
+    UPDATE Usuarios
+    SET Foto_perfil = ?, profile_image_mime = ?
+    WHERE Id_Usuarios = ?
+"""
+
+
 def fetch_user_by_id(db: Database, user_id: int) -> Optional[dict]:
-    query = """
-        SELECT
-            Id_Usuarios AS user_id,
-            username,
-            NombreCompleto AS full_name,
-            email,
-            Foto_perfil AS profile_image
-        FROM Usuarios
-        WHERE Id_Usuarios = ?
-        LIMIT 1
-    """
-    rows = db.fetch_query(query, (user_id,))
+    rows = db.fetch_query(USER_BY_ID_QUERY, (user_id,))
     if not rows:
         return None
     return rows[0]
 
 
-def update_user_profile_image(db: Database, user_id: int, relative_path: str | None) -> None:
-    query = """
-        UPDATE Usuarios
-        SET Foto_perfil = ?
-        WHERE Id_Usuarios = ?
-    """
-    db.execute_query(query, (relative_path, user_id))
+def replace_user_profile_image(
+    db: Database,
+    user_id: int,
+    relative_path: str | None,
+    mime_type: str | None = None,
+) -> tuple[bool, Optional[str]]:
+    # Lee la imagen anterior y guarda la nueva en una sola transacción.
+    # SQLite solo expone los valores nuevos en RETURNING, por eso la ruta
+    # previa se lee dentro de la misma transacción. Retorna
+    # (usuario existe, ruta anterior).
+    with db.transaction():
+        rows = db.fetch_query(PROFILE_IMAGE_BY_ID_QUERY, (user_id,))
+        if not rows:
+            return False, None
+        db.execute_query(UPDATE_PROFILE_IMAGE_QUERY, (relative_path, mime_type, user_id))
+    return True, rows[0]["profile_image"]
 
 
 def fetch_user_by_username(db: Database, username: str) -> Optional[dict]:
@@ -39,18 +71,7 @@ def fetch_user_by_username(db: Database, username: str) -> Optional[dict]:
     if not normalized:
         return None
 
-    query = """
-        SELECT
-            Id_Usuarios AS user_id,
-            username,
-            NombreCompleto AS full_name,
-            email,
-            Foto_perfil AS profile_image
-        FROM Usuarios
-        WHERE LOWER(username) = LOWER(?)
-        LIMIT 1
-    """
-    rows = db.fetch_query(query, (normalized,))
+    rows = db.fetch_query(USER_BY_USERNAME_QUERY, (normalized,))
     if not rows:
         return None
     return rows[0]
@@ -1,18 +1,105 @@
 # main.py
 
 # Import libraries
+from contextlib import asynccontextmanager
+from anyio import to_thread
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
+import logging
 import os
+import re
 
 # Import modules
 from routers import auth, websocket, chats, files, users
 from database.singleton import Database
+from routers.websocket import redis_async, redis_pubsub
+from database.schema import ensure_columns, ensure_indexes, ensure_user_search_index
+
+logger = logging.getLogger(__name__)
+
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
+
+# Margen para los encabezados y delimitadores del formulario multipart, que
+# también cuentan en Content-Length.
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+# (método, ruta) de las subidas de archivos -> tamaño máximo del archivo.
+UPLOAD_LIMITS = (
+    ("PUT", re.compile(r"/users/me/avatar"), users.PROFILE_IMAGE_MAX_BYTES),
+    ("POST", re.compile(r"/files/chats/[0-9]+/attachments"), files.ATTACHMENT_MAX_BYTES),
+)
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Rechaza con 413 las subidas cuyo Content-Length ya excede el límite de
+    la ruta, antes de que FastAPI lea el cuerpo para parsear el formulario.
+    El tamaño exacto del archivo se sigue validando en cada endpoint.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http":
+            max_bytes = self._limit_for(scope["method"], scope["path"])
+            if max_bytes is not None:
+                content_length = self._content_length(scope)
+                if content_length is not None and content_length > max_bytes + UPLOAD_FORM_OVERHEAD:
+                    response = ORJSONResponse(
+                        status_code=413,
+                        content={"detail": "El archivo excede el tamaño máximo permitido."},
+                        headers={"Connection": "close"},
+                    )
+                    await response(scope, receive, send)
+                    return
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    def _limit_for(method: str, path: str) -> int | None:
+        for limit_method, pattern, max_bytes in UPLOAD_LIMITS:
+            if method == limit_method and pattern.fullmatch(path):
+                return max_bytes
+        return None
+
+    @staticmethod
+    def _content_length(scope) -> int | None:
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    return int(value)
+                except ValueError:
+                    return None
+        return None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Los endpoints síncronos (def) y run_in_threadpool comparten este
+    # límite de hilos; por defecto AnyIO solo permite 40 simultáneos.
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # Abre la base de datos y crea los índices antes de aceptar peticiones,
+    # para que la primera consulta no pague ese costo.
+    db: Database = Database()
+    ensure_columns(db)
+    ensure_indexes(db)
+    ensure_user_search_index(db)
+    # Abre la primera conexión del pool de Redis; si Redis no está
+    # disponible el servidor arranca igual.
+    try:
+        await redis_async.ping()
+    except Exception as exc:
+        logger.warning("Redis no disponible al arrancar: %s", exc)
+    yield
+    await redis_async.aclose()
+    await redis_pubsub.aclose()
+    db.close_connection()
 
 # Start server
-app: FastAPI = FastAPI()
+# ORJSONResponse serializa las respuestas con orjson (implementado en C).
+app: FastAPI = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Add routers
 app.include_router(auth.router_authentication)
@@ -21,6 +108,8 @@ app.include_router(chats.router_chats)
 app.include_router(files.router_files)
 app.include_router(users.router_users)
 
+app.add_middleware(UploadSizeLimitMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://127.0.0.1:3000", "http://localhost:3000",],
@@ -31,15 +120,6 @@ app.add_middleware(
 
 load_dotenv()
 
-@app.on_event("startup")
-def startup_event():
-    db: Database = Database()
-
-@app.on_event("shutdown")
-def shutdown_event():
-    db: Database = Database()
-    db.close_connection()
-
 @app.get("/ison")
 async def ison():
     return {"message": "Yeah, I'm on!"}
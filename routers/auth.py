@@ -10,20 +10,28 @@ Module developed to manage user authentication
 
 # Import libraries
 from fastapi import APIRouter, HTTPException, Depends, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from cachetools import TTLCache
+import hashlib
+import hmac
+import logging
 import os
+import secrets
+import threading
+import time
 from pydantic import BaseModel
 #import redis
 
 # Importamos la clase para la base de datos
-from database.singleton import Database
+from database.singleton import Database, get_db
 
 # Iniciamos router
 router_authentication: APIRouter = APIRouter(prefix="/auth")
+logger = logging.getLogger(__name__)
 #r = redis.Redis(host='localhost', port=6379, db=0)
 
 # Cargar variables de entorno
@@ -44,12 +52,37 @@ ALGORITHM = (os.getenv("ALGORITHM") or "HS256").strip('"').strip("'")
 crypt =  CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 ACCESS_TOKEN_DURATION = int(os.getenv("ACCESS_TOKEN_DURATION", 30))
+ACCESS_TOKEN_TTL_SECONDS = ACCESS_TOKEN_DURATION * 60
+
+# Argumentos de jwt.decode calculados una sola vez.
+JWT_ALGORITHMS = [ALGORITHM]
+JWT_DECODE_OPTIONS = {"verify_signature": True, "require_sub": True}
 
 SECRET = (os.getenv("SECRET") or "").strip('"').strip("'")
 
 if not SECRET:
     raise RuntimeError("SECRET env variable is missing. Set SECRET in the environment or .env file.")
 
+# Caché de verificaciones bcrypt exitosas. La llave incluye el hash guardado,
+# así que un cambio de contraseña invalida la entrada; la contraseña solo se
+# guarda como HMAC con una llave aleatoria propia del proceso.
+PASSWORD_CACHE_TTL = int(os.getenv("PASSWORD_CACHE_TTL", 60))
+_password_cache: TTLCache = TTLCache(maxsize=1024, ttl=PASSWORD_CACHE_TTL)
+_password_cache_lock = threading.Lock()
+_password_cache_key = secrets.token_bytes(32)
+
+def verify_password(username: str, password: str, hashed_password: str) -> bool:
+    digest = hmac.new(_password_cache_key, password.encode("utf-8"), hashlib.sha256).digest()
+    cache_key = (username, digest, hashed_password)
+    with _password_cache_lock:
+        if _password_cache.get(cache_key):
+            return True
+    if not crypt.verify(password, hashed_password):
+        return False
+    with _password_cache_lock:
+        _password_cache[cache_key] = True
+    return True
+
 """
 Model classes for users
 """
@@ -92,79 +125,159 @@ def search_user_private(username: str):
             typeUser=user_db["Tipo_usuario"],
         )
 
-    except Exception as e:
-        print(f"Error en search_user_private(): {e}")
+    except Exception:
+        logger.exception("Error en search_user_private()")
         return None
     
+# Caché de usuarios por id: cada petición autenticada busca a su usuario,
+# así que durante USER_CACHE_TTL segundos se evita repetir el SELECT.
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 30))
+_user_cache: TTLCache = TTLCache(maxsize=4096, ttl=USER_CACHE_TTL)
+_user_cache_lock = threading.Lock()
+
 def search_user(user_iD: int):
+    with _user_cache_lock:
+        cached_user = _user_cache.get(user_iD)
+    if cached_user is not None:
+        return cached_user
     try:
         database = Database()
         user_db_list = database.fetch_query(search_user_by_id_query, (user_iD,))
         if not user_db_list:
             return None
         user_db = user_db_list[0]
-        return User(
+        user = User(
             user_id=user_db["Id_Usuarios"],
             username=user_db["username"],
             name=user_db["NombreCompleto"],
             email=user_db["email"]
         )
-    except Exception as e:
-        print(f"Error en search_user: {e}")
+    except Exception:
+        logger.exception("Error en search_user()")
         return None
+    with _user_cache_lock:
+        _user_cache[user_iD] = user
+    return user
 
-invalid_token_exception: HTTPException = HTTPException(
-    status_code=status.HTTP_401_UNAUTHORIZED,
-    detail="Invalid token",
-    headers={"WWW-Authenticate": "Bearer"},
-) 
+# Caché de tokens ya validados: huella del token -> (User, exp). Un acierto
+# evita tanto jwt.decode como la búsqueda del usuario; la expiración del token
+# se sigue respetando aunque la entrada siga viva en la caché. La llave es un
+# blake2b del token para no guardar los tokens en claro.
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", 60))
+_token_cache: TTLCache = TTLCache(maxsize=8192, ttl=TOKEN_CACHE_TTL)
+_token_cache_lock = threading.Lock()
+
+def invalidate_user_cache(user_iD: int) -> None:
+    # Se llama cuando cambian los datos del usuario.
+    with _user_cache_lock:
+        _user_cache.pop(user_iD, None)
+    with _token_cache_lock:
+        stale_tokens = [
+            token for token, (user, _) in _token_cache.items() if user.user_id == user_iD
+        ]
+        for token in stale_tokens:
+            _token_cache.pop(token, None)
+
+# Cada raise construye su propia HTTPException: una instancia compartida a
+# nivel de módulo acumularía __traceback__ y __context__ (con los locals de la
+# petición, incluida la contraseña) entre peticiones.
+def invalid_token_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+def incorrect_username_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Incorrect username or user does not exist"
+    )
+
+def incorrect_password_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Incorrect password"
+    )
+
+def _token_fingerprint(token: str) -> bytes:
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+
+
+def _cached_token_user(fingerprint: bytes) -> User | None:
+    with _token_cache_lock:
+        cached = _token_cache.get(fingerprint)
+    if cached is None:
+        return None
+    cached_user, expires_at = cached
+    if expires_at is None or expires_at > time.time():
+        return cached_user
+    return None
 
-async def auth_user(token: str = Depends(oauth2)):
-    try:
-        payload = jwt.decode(token, SECRET, algorithms=[ALGORITHM])
-        print("Payload decodificado:", payload)  # Depuración
-        user_iD_str = payload.get("sub")
-        if user_iD_str is None:
-            print("No se encontró 'sub' en el token")
-            raise invalid_token_exception
-        user_iD = int(user_iD_str)  # Convertir a entero
-    except JWTError as e:
-        print("Error al decodificar token:", e)
-        raise invalid_token_exception
+
+def verify_token(token: str, fingerprint: bytes | None = None) -> User | None:
+    # Decodifica el JWT y busca a su usuario. Lanza JWTError (o ValueError)
+    # si el token es inválido y retorna None si el usuario no existe.
+    payload = jwt.decode(token, SECRET, algorithms=JWT_ALGORITHMS, options=JWT_DECODE_OPTIONS)
+    user_iD_str = payload.get("sub")
+    if user_iD_str is None:
+        raise JWTError("No se encontró 'sub' en el token")
+    user_iD = int(user_iD_str)  # Convertir a entero
 
     user = search_user(user_iD)
     if user is None:
-        print("Usuario no encontrado en la base de datos")
-        raise invalid_token_exception
+        return None
+
+    expires_at = payload.get("exp")
+    if not isinstance(expires_at, (int, float)):
+        expires_at = None
+    with _token_cache_lock:
+        _token_cache[fingerprint or _token_fingerprint(token)] = (user, expires_at)
+    return user
+
+
+async def authenticate_token(token: str) -> User | None:
+    # Un token ya validado se resuelve desde la caché sin salir del event
+    # loop; en caso contrario jwt.decode y la búsqueda del usuario corren en
+    # el threadpool para no bloquear a las demás conexiones.
+    fingerprint = _token_fingerprint(token)
+    cached_user = _cached_token_user(fingerprint)
+    if cached_user is not None:
+        return cached_user
+    return await run_in_threadpool(verify_token, token, fingerprint)
+
+
+async def auth_user(token: str = Depends(oauth2)):
+    try:
+        user = await authenticate_token(token)
+    except (JWTError, ValueError) as e:
+        logger.debug("Error al decodificar token: %s", e)
+        raise invalid_token_exception()
+    if user is None:
+        logger.debug("Usuario no encontrado en la base de datos")
+        raise invalid_token_exception()
     return user
 
 def current_user(user: User = Depends(auth_user)):
     return user
 
 @router_authentication.post("/login")
-async def login(form: OAuth2PasswordRequestForm = Depends()):
+def login(form: OAuth2PasswordRequestForm = Depends()):
     # Se busca el usuario por username (que es de tipo string)
     user = search_user_private(form.username)
     if not user:
-        print("Error: Usuario no encontrado")
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Incorrect username or user does not exist"
-        )
+        logger.debug("Error: Usuario no encontrado")
+        raise incorrect_username_exception()
 
     #Verificamos la contraseña (asumiendo que está encriptada con bcrypt)
-    if not crypt.verify(form.password, user.password):
-        print("Error: Contraseña incorrecta")
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Incorrect password"
-        )
+    if not verify_password(user.username, form.password, user.password):
+        logger.debug("Error: Contraseña incorrecta")
+        raise incorrect_password_exception()
 
     #Generamos el token
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_DURATION)
     payload = {
         "sub": str(user.user_id),
-        "exp": datetime.utcnow() + access_token_expires
+        "exp": int(time.time()) + ACCESS_TOKEN_TTL_SECONDS
     }
     encoded_jwt = jwt.encode(payload, SECRET, algorithm=ALGORITHM)
 
@@ -184,12 +297,12 @@ async def me(user: User = Depends(current_user)):
     return user
 
 @router_authentication.get("/getUserInfo/{otherUser}")
-async def getUserInfo(
+def getUserInfo(
     user: User = Depends(current_user),
+    db: Database = Depends(get_db),
     otherUser: str = ""
 ):
     try:
-        db = Database()
         db_user = db.fetch_query(search_user_by_username_query, (otherUser,))
         if not db_user:
             return None
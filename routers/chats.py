@@ -3,33 +3,45 @@ from __future__ import annotations
 # chats.py
 
 # Importamos librerías
+import asyncio
+import json
 import logging
+import os
+import threading
 from typing import Optional, List
 
-from fastapi import APIRouter, HTTPException, Depends, status
-from pydantic import BaseModel
+from cachetools import TTLCache
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 
 # Importamos módulos
 from routers.auth import current_user, User
-from database.singleton import Database
-from database.attachments import fetch_attachments_by_message_ids, serialize_attachment
-from routers.websocket import notify_new_message
+from database.singleton import Database, get_db
+from database.attachments import hydrate_message_attachments
+from database.schema import USER_SEARCH_TABLE
+from routers.websocket import notify_new_message, redis_async
 
 router_chats: APIRouter = APIRouter(prefix="/chats")
 
+# Las consultas a SQLite son bloqueantes: las rutas async las ejecutan con
+# run_in_threadpool para no detener el event loop. Cada hilo del pool tiene
+# su propia conexión de larga vida (ver Database), con su caché de páginas.
+
 logger = logging.getLogger(__name__)
 
+# Caché de membresías (chat_id, user_id) -> bool. Se invalida cuando se
+# agregan miembros a un chat (ver invalidate_membership).
+MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", 60))
+_membership_cache: TTLCache = TTLCache(maxsize=65536, ttl=MEMBERSHIP_CACHE_TTL)
+_membership_cache_lock = threading.Lock()
 
-def _extract_user_id(user: User) -> int:
-    user_id = getattr(user, "user_id", None)
-    if user_id is None:
-        user_id = getattr(user, "iD", None)
-    if user_id is None:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="No fue posible determinar el identificador del usuario autenticado.",
-        )
-    return user_id
+# Caché username -> user_id. Solo se guardan usernames encontrados para que
+# un usuario recién registrado aparezca de inmediato.
+USERNAME_CACHE_TTL = int(os.getenv("USERNAME_CACHE_TTL", 300))
+_username_cache: TTLCache = TTLCache(maxsize=4096, ttl=USERNAME_CACHE_TTL)
+_username_cache_lock = threading.Lock()
 
 
 @router_chats.get("/ison")
@@ -40,54 +52,57 @@ async def is_active():
 PARA EL ENVÍO DE MENSAJES
 """
 
+MESSAGE_MAX_LENGTH = 4000
+
 # MODELO Pydantic para la entrada
 class MessageCreate(BaseModel):
-    content: str
+    content: str = Field(min_length=1, max_length=MESSAGE_MAX_LENGTH)
 
 
 class PaginationMeta(BaseModel):
     older_cursor: str | None = None
     has_more_older: bool = False
 
-# Función para crear un mensaje en la BD
-def create_message(db: Database, chat_id: int, user_id: int, content: str) -> dict:
-    insert_query = """
-        INSERT INTO messages (chat_id, user_id, content, created_at)
-        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-    """
-    db.execute_query(insert_query, (chat_id, user_id, content))
+INSERT_MESSAGE_QUERY = """
+    INSERT INTO messages (chat_id, user_id, content, created_at)
+    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    RETURNING message_id, created_at
+"""
 
-    row = db.fetch_query("SELECT last_insert_rowid() AS message_id")
-    if not row:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="No se pudo obtener el identificador del mensaje recién creado."
-        )
+TOUCH_CHAT_ACTIVITY_QUERY = """
+    UPDATE chats
+    SET last_activity = ?
+    WHERE chat_id = ?
+"""
 
-    message_id = row[0]["message_id"]
-    db.execute_query(
-        """
-        UPDATE chats
-        SET last_activity = CURRENT_TIMESTAMP
-        WHERE chat_id = ?
-        """,
-        (chat_id,),
-    )
-    message_rows = db.fetch_query(
-        """
-        SELECT
-            m.message_id,
-            m.chat_id,
-            m.user_id,
-            u.username AS sender_username,
-            m.content,
-            m.created_at
-        FROM messages AS m
-        INNER JOIN Usuarios AS u ON u.Id_Usuarios = m.user_id
-        WHERE m.message_id = ?
-        """,
-        (message_id,),
-    )
+MESSAGE_BY_ID_QUERY = """
+    SELECT
+        m.message_id,
+        m.chat_id,
+        m.user_id,
+        u.username AS sender_username,
+        m.content,
+        m.created_at
+    FROM messages AS m
+    INNER JOIN Usuarios AS u ON u.Id_Usuarios = m.user_id
+    WHERE m.message_id = ?
+"""
+
+# Función para crear un mensaje en la BD
+def create_message(db: Database, chat_id: int, user_id: int, content: str) -> dict:
+    # INSERT, actualización de last_activity y lectura del mensaje
+    # se confirman en una sola transacción.
+    with db.transaction():
+        inserted = db.execute_returning(INSERT_MESSAGE_QUERY, (chat_id, user_id, content))
+        if not inserted:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="No se pudo obtener el identificador del mensaje recién creado."
+            )
+
+        message_id = inserted[0]["message_id"]
+        db.execute_query(TOUCH_CHAT_ACTIVITY_QUERY, (inserted[0]["created_at"], chat_id))
+        message_rows = db.fetch_query(MESSAGE_BY_ID_QUERY, (message_id,))
     if not message_rows:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -98,26 +113,44 @@ def create_message(db: Database, chat_id: int, user_id: int, content: str) -> di
     message["attachments"] = []
     return message
 
+def create_messages(db: Database, items: List[tuple[int, int, str]]) -> List[dict | Exception]:
+    # Guarda varios mensajes (chat_id, user_id, content) en una sola
+    # transacción: un solo commit para todo el lote. Cada mensaje va en su
+    # propio SAVEPOINT, así que si uno falla solo se revierte ese; en su
+    # posición se retorna la excepción en lugar del mensaje.
+    results: List[dict | Exception] = []
+    with db.transaction():
+        for chat_id, user_id, content in items:
+            try:
+                with db.savepoint():
+                    results.append(create_message(db, chat_id, user_id, content))
+            except Exception as exc:
+                results.append(exc)
+    return results
+
+async def safe_notify_new_message(message: dict) -> None:
+    # Los fallos en la notificación no deben afectar al mensaje ya guardado.
+    try:
+        await notify_new_message(message)
+    except Exception:
+        logger.exception(
+            "Fallo al notificar un mensaje nuevo para el chat %s", message.get("chat_id")
+        )
+
 @router_chats.post("/{chat_id}/send_message")
 async def send_message_to_chat(
     chat_id: int,
     message: MessageCreate,
-    user: User = Depends(current_user)
+    background_tasks: BackgroundTasks,
+    user: User = Depends(current_user),
+    db: Database = Depends(get_db),
 ):
     """
     Envía (crea) un mensaje en el chat con id = chat_id,
-    usando el usuario logueado (user.iD) como remitente.
+    usando el usuario logueado (user.user_id) como remitente.
     Retorna el mensaje recién creado.
     """
-    db = Database()
-    user_id = _extract_user_id(user)
-
-    if not _user_is_member(db, chat_id, user_id):
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="No tienes permiso para enviar mensajes a este chat.",
-        )
-
+    # El contenido se valida antes de tocar la base de datos.
     content = message.content.strip()
     if not content:
         raise HTTPException(
@@ -125,15 +158,19 @@ async def send_message_to_chat(
             detail="El contenido del mensaje no puede estar vacío.",
         )
 
-    message_created = create_message(db, chat_id, user_id, content)
+    user_id = user.user_id
 
-    try:
-        await notify_new_message(message_created)
-    except Exception:
-        logger.exception(
-            "Fallo al notificar un mensaje nuevo para el chat %s", chat_id
+    if not await run_in_threadpool(_user_is_member, db, chat_id, user_id):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="No tienes permiso para enviar mensajes a este chat.",
         )
 
+    message_created = await run_in_threadpool(create_message, db, chat_id, user_id, content)
+
+    # La difusión por WebSocket corre después de enviar la respuesta.
+    background_tasks.add_task(safe_notify_new_message, message_created)
+
     return message_created
 
 
@@ -143,63 +180,121 @@ Para la búsqueda de usuarios en la navbar:
 - Querys de mensajes
 """
 
+USER_ID_BY_USERNAME_QUERY = """
+    SELECT Id_Usuarios AS user_id
+    FROM Usuarios
+    WHERE username = ?
+    LIMIT 1
+"""
+
 def find_user_by_username(db: Database, username: str) -> Optional[int]:
-    query = """
-        SELECT Id_Usuarios AS user_id
-        FROM Usuarios
-        WHERE username = ?
-        LIMIT 1
-    """
-    result = db.fetch_query(query, (username,))
+    with _username_cache_lock:
+        cached_id = _username_cache.get(username)
+    if cached_id is not None:
+        return cached_id
+    result = db.fetch_query(USER_ID_BY_USERNAME_QUERY, (username,))
     if not result:
         return None
-    return result[0]["user_id"]
+    user_id = result[0]["user_id"]
+    with _username_cache_lock:
+        _username_cache[username] = user_id
+    return user_id
+
+SINGLE_CHAT_QUERY = """
+    SELECT c.chat_id
+    FROM chat_members AS a
+    INNER JOIN chats AS c ON c.chat_id = a.chat_id
+    WHERE a.user_id = ?
+      AND c.is_group = 0
+      AND EXISTS (
+          SELECT 1 FROM chat_members AS b
+          WHERE b.chat_id = a.chat_id AND b.user_id = ?
+      )
+    LIMIT 1
+"""
 
 def find_single_chat(db: Database, user_a_id: int, user_b_id: int) -> Optional[int]:
-    query = """
-        SELECT c.chat_id
-        FROM chats c
-        WHERE c.is_group = 0
-          AND c.chat_id IN (
-              SELECT chat_id FROM chat_members WHERE user_id = ?
-          )
-          AND c.chat_id IN (
-              SELECT chat_id FROM chat_members WHERE user_id = ?
-          )
-        LIMIT 1
-    """
-    rows = db.fetch_query(query, (user_a_id, user_b_id))
+    rows = db.fetch_query(SINGLE_CHAT_QUERY, (user_a_id, user_b_id))
     if not rows:
         return None
     return rows[0]["chat_id"]
 
-def create_single_chat(db: Database, creator_id: int, other_user_id: int) -> int:
-    insert_chat = """
-        INSERT INTO chats (is_group, created_by, created_at, last_activity)
-        VALUES (0, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-    """
-    db.execute_query(insert_chat, (creator_id,))
+INSERT_SINGLE_CHAT_QUERY = """
+    INSERT INTO chats (is_group, created_by, created_at, last_activity)
+    VALUES (0, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+"""
 
-    new_chat_row = db.fetch_query("SELECT last_insert_rowid() AS chat_id")
-    if not new_chat_row:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="No se pudo crear el chat individual."
+INSERT_SINGLE_CHAT_MEMBERS_QUERY = """
+    INSERT OR IGNORE INTO chat_members (chat_id, user_id, joined_at, role)
+    VALUES (?, ?, CURRENT_TIMESTAMP, ?),
+           (?, ?, CURRENT_TIMESTAMP, ?)
+"""
+
+def create_single_chat(db: Database, creator_id: int, other_user_id: int) -> int:
+    # Puede unirse a una transacción externa: en ese caso quien llama debe
+    # invalidar la caché de membresía después del COMMIT externo.
+    with db.transaction():
+        chat_id = db.execute_query(INSERT_SINGLE_CHAT_QUERY, (creator_id,))
+        if not chat_id:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="No se pudo crear el chat individual."
+            )
+
+        db.execute_query(
+            INSERT_SINGLE_CHAT_MEMBERS_QUERY,
+            (
+                chat_id, creator_id, "admin",
+                chat_id, other_user_id, "member",
+            ),
         )
-    chat_id = new_chat_row[0]["chat_id"]
 
-    insert_members = """
-        INSERT OR IGNORE INTO chat_members (chat_id, user_id, joined_at, role)
-        VALUES (?, ?, CURRENT_TIMESTAMP, ?)
-    """
-    db.executemany(
-        insert_members,
-        [
-            (chat_id, creator_id, "admin"),
-            (chat_id, other_user_id, "member"),
-        ],
-    )
+    return chat_id
+
+CHAT_MESSAGES_SELECT = """
+    SELECT
+        m.message_id,
+        m.chat_id,
+        m.user_id,
+        u.username AS sender_username,
+        m.content,
+        m.created_at
+    FROM messages AS m
+    INNER JOIN Usuarios AS u ON u.Id_Usuarios = m.user_id
+    WHERE m.chat_id = ?
+"""
 
+CHAT_MESSAGES_QUERY = CHAT_MESSAGES_SELECT + """
+    ORDER BY m.created_at DESC
+    LIMIT ?
+"""
+
+CHAT_MESSAGES_BEFORE_CURSOR_QUERY = CHAT_MESSAGES_SELECT + """
+      AND m.created_at < ?
+    ORDER BY m.created_at DESC
+    LIMIT ?
+"""
+
+def find_or_create_single_chat(db: Database, requester_id: int, other_user_id: int) -> int:
+    """
+    Retorna el chat individual entre ambos usuarios, creándolo si no existe.
+    El caso común (el chat ya existe) es una sola consulta; la creación
+    vuelve a buscar dentro de BEGIN IMMEDIATE para que dos peticiones
+    simultáneas no creen chats duplicados.
+    """
+    chat_id = find_single_chat(db, requester_id, other_user_id)
+    if chat_id is not None:
+        return chat_id
+    created = False
+    with db.transaction():
+        chat_id = find_single_chat(db, requester_id, other_user_id)
+        if chat_id is None:
+            chat_id = create_single_chat(db, requester_id, other_user_id)
+            created = True
+    # Se invalida ya confirmado el COMMIT: antes, otra conexión todavía
+    # podría leer "no es miembro" y guardarlo en caché todo el TTL.
+    if created:
+        invalidate_membership(chat_id, requester_id, other_user_id)
     return chat_id
 
 def fetch_chat_messages(
@@ -213,55 +308,42 @@ def fetch_chat_messages(
     Usa older_cursor (timestamp ISO) para paginar hacia mensajes más antiguos.
     """
     base_limit = max(limit, 1)
-    query = """
-        SELECT
-            m.message_id,
-            m.chat_id,
-            m.user_id,
-            u.username AS sender_username,
-            m.content,
-            m.created_at
-        FROM messages AS m
-        INNER JOIN Usuarios AS u ON u.Id_Usuarios = m.user_id
-        WHERE m.chat_id = ?
-    """
-    params: list = [chat_id]
+    # +1 para detectar si hay más mensajes antiguos
     if older_cursor:
-        query += " AND m.created_at < ?"
-        params.append(older_cursor)
-
-    query += " ORDER BY m.created_at DESC LIMIT ?"
-    params.append(base_limit + 1)  # +1 para detectar si hay más mensajes antiguos
+        query = CHAT_MESSAGES_BEFORE_CURSOR_QUERY
+        params: tuple = (chat_id, older_cursor, base_limit + 1)
+    else:
+        query = CHAT_MESSAGES_QUERY
+        params = (chat_id, base_limit + 1)
 
-    rows = db.fetch_query(query, tuple(params)) or []
+    rows = db.fetch_query(query, params) or []
 
+    # La fila centinela se descarta y la lista se invierte en su lugar,
+    # sin crear copias intermedias.
     has_more = len(rows) > base_limit
-    trimmed = rows[:base_limit]
-    trimmed.reverse()  # Cronológico ascendente
+    if has_more:
+        del rows[base_limit:]
+    rows.reverse()  # Cronológico ascendente
 
-    message_ids = [message["message_id"] for message in trimmed]
-    attachments_map = fetch_attachments_by_message_ids(db, message_ids)
-    for message in trimmed:
-        attachments = attachments_map.get(message["message_id"], [])
-        message["attachments"] = [serialize_attachment(item) for item in attachments]
+    hydrate_message_attachments(db, rows)
 
     meta = PaginationMeta()
-    if trimmed:
-        meta.older_cursor = trimmed[0]["created_at"]
+    if rows:
+        meta.older_cursor = rows[0]["created_at"]
     meta.has_more_older = has_more
 
-    return trimmed, meta
+    return rows, meta
 
 ### AQUI LA RUTA PRINCIPAL QUE RECIBE UN STRING (target_username)
-@router_chats.get("/open_single_chat/{target_username}")
-async def open_single_chat(
+@router_chats.get("/open_single_chat/{target_username}", response_model=None)
+def open_single_chat(
     target_username: str,
     limit: int = 20,
     older_cursor: str | None = None,
     user: User = Depends(current_user),  # <--- 'user' viene de tu modelo 'User' con iD, username, ...
+    db: Database = Depends(get_db),
 ):
-    db = Database()
-    requester_id = _extract_user_id(user)
+    requester_id = user.user_id
 
     if target_username == getattr(user, "username", None):
         raise HTTPException(
@@ -276,122 +358,181 @@ async def open_single_chat(
             detail=f"No se encontró usuario con username '{target_username}'.",
         )
 
-    existing_chat_id = find_single_chat(db, requester_id, other_user_id)
-    if existing_chat_id is None:
-        existing_chat_id = create_single_chat(db, requester_id, other_user_id)
+    existing_chat_id = find_or_create_single_chat(db, requester_id, other_user_id)
 
     messages, meta = fetch_chat_messages(db, existing_chat_id, limit, older_cursor)
 
-    return {
+    return ORJSONResponse({
         "chat_id": existing_chat_id,
         "messages": messages,
         "pagination": meta.model_dump(),
-    }
+    })
 
 @router_chats.get("/me")
 async def me(user: User = Depends(current_user)):
     return user
 
-@router_chats.get("/search_user_navbar/{terminoBusqueda}")
-async def search_user(user: User = Depends(current_user), terminoBusqueda: str = None):
-    db = Database()  # Obtén la instancia del Singleton
-    if terminoBusqueda is None or terminoBusqueda.strip() == "":
-        return []
+# Búsqueda sobre la tabla FTS5 (trigram) de usernames; el LIKE con comodín
+# inicial se resuelve con el índice en lugar de recorrer Usuarios.
+# Se pide una fila extra para poder excluir al usuario que busca sin
+# depender de él en la consulta, así el resultado se puede compartir en caché.
+SEARCH_USER_LIMIT = 20
+SEARCH_USERS_QUERY = f"""
+    SELECT rowid AS user_id, username
+    FROM {USER_SEARCH_TABLE}
+    WHERE username LIKE ?
+    ORDER BY username ASC
+    LIMIT {SEARCH_USER_LIMIT + 1}
+"""
 
-    user_id = _extract_user_id(user)
-    like_pattern = f"%{terminoBusqueda}%"
+SEARCH_USER_MIN_LENGTH = 2
+SEARCH_USER_CACHE_TTL = int(os.getenv("SEARCH_USER_CACHE_TTL", 30))
 
-    query = """
-        SELECT username
-        FROM Usuarios
-        WHERE username LIKE ?
-          AND Id_Usuarios != ?
-        ORDER BY username ASC
-        LIMIT 20
-    """
-    rows = db.fetch_query(query, (like_pattern, user_id))
-    if not rows:
+
+def _search_cache_key(term: str) -> str:
+    return f"navbar:{term.lower()}"
+
+
+async def _search_usernames(db: Database, term: str) -> list:
+    # Retorna pares [user_id, username]; primero intenta Redis y, si no hay
+    # entrada (o Redis no está disponible), consulta SQLite y la guarda.
+    key = _search_cache_key(term)
+    try:
+        cached = await redis_async.get(key)
+    except Exception as exc:
+        logger.debug("No se pudo leer la caché de búsqueda: %s", exc)
+        cached = None
+    if cached is not None:
+        return json.loads(cached)
+
+    rows = await run_in_threadpool(db.fetch_query, SEARCH_USERS_QUERY, (f"%{term}%",))
+    if rows is None:
+        return []
+    matches = [[row["user_id"], row["username"]] for row in rows]
+    try:
+        await redis_async.setex(key, SEARCH_USER_CACHE_TTL, json.dumps(matches))
+    except Exception as exc:
+        logger.debug("No se pudo guardar la caché de búsqueda: %s", exc)
+    return matches
+
+@router_chats.get("/search_user_navbar/{terminoBusqueda}")
+async def search_user(
+    user: User = Depends(current_user),
+    db: Database = Depends(get_db),
+    terminoBusqueda: str = None,
+):
+    if terminoBusqueda is None or len(terminoBusqueda.strip()) < SEARCH_USER_MIN_LENGTH:
         return []
-    return [row["username"] for row in rows]
 
-@router_chats.get("/my_chats", tags=["Chats"])
-async def get_my_chats(limit: int = 10, offset: int = 0, user: User = Depends(current_user)):
+    user_id = user.user_id
+    matches = await _search_usernames(db, terminoBusqueda)
+    usernames = [username for match_id, username in matches if match_id != user_id]
+    return usernames[:SEARCH_USER_LIMIT]
+
+# El otro participante de un chat individual se resuelve con LEFT JOINs
+# (indexados) en lugar de una subconsulta correlacionada por fila.
+MY_CHATS_QUERY = """
+    SELECT
+        c.chat_id,
+        c.is_group,
+        COALESCE(c.last_activity, c.created_at) AS last_activity,
+        CASE
+            WHEN c.is_group = 0 THEN u2.username
+            ELSE COALESCE(g.nombre, 'Grupo Chat')
+        END AS chat_name
+    FROM chat_members AS cm
+    INNER JOIN chats AS c ON c.chat_id = cm.chat_id
+    LEFT JOIN chat_members AS cm2
+        ON cm2.chat_id = c.chat_id
+       AND c.is_group = 0
+       AND cm2.user_id != ?
+    LEFT JOIN Usuarios AS u2 ON u2.Id_Usuarios = cm2.user_id
+    LEFT JOIN info_grupos AS g ON g.chat_id = c.chat_id
+    WHERE cm.user_id = ?
+    ORDER BY last_activity DESC
+    LIMIT ? OFFSET ?
+"""
+
+@router_chats.get("/my_chats", tags=["Chats"], response_model=None)
+def get_my_chats(
+    limit: int = 10,
+    offset: int = 0,
+    user: User = Depends(current_user),
+    db: Database = Depends(get_db),
+):
     """
     Retorna los chats en los que el usuario actual es miembro, ordenados por la última actividad.
     - Para chats individuales (is_group = 0): retorna el username del otro participante.
     - Para chats grupales (is_group = 1): retorna 'Grupo Chat' (puedes ajustar si agregas nombre de grupo).
     La paginación se maneja con LIMIT y OFFSET.
     """
-    db = Database()
-    user_id = _extract_user_id(user)
+    user_id = user.user_id
     limit = max(limit, 1)
     offset = max(offset, 0)
 
-    query = """
-        SELECT
-            c.chat_id,
-            c.is_group,
-            COALESCE(c.last_activity, c.created_at) AS last_activity,
-            CASE
-                WHEN c.is_group = 0 THEN (
-                    SELECT username
-                    FROM Usuarios
-                    WHERE Id_Usuarios = (
-                        SELECT cm2.user_id
-                        FROM chat_members AS cm2
-                        WHERE cm2.chat_id = c.chat_id AND cm2.user_id != ?
-                        LIMIT 1
-                    )
-                )
-                ELSE COALESCE(g.nombre, 'Grupo Chat')
-            END AS chat_name
-        FROM chats AS c
-        INNER JOIN chat_members AS cm ON cm.chat_id = c.chat_id
-        LEFT JOIN info_grupos AS g ON g.chat_id = c.chat_id
-        WHERE cm.user_id = ?
-        ORDER BY last_activity DESC
-        LIMIT ? OFFSET ?
-    """
-
-    rows = db.fetch_query(query, (user_id, user_id, limit, offset))
-    return {"chats": rows or []}
+    rows = db.fetch_query(MY_CHATS_QUERY, (user_id, user_id, limit, offset))
+    return ORJSONResponse({"chats": rows or []})
 
-@router_chats.get("/get_chat/{chat_id}", tags=["Chats"])
+@router_chats.get("/get_chat/{chat_id}", tags=["Chats"], response_model=None)
 async def get_chat(
     chat_id: int,
     limit: int = 20,
     older_cursor: str | None = None,
-    user: User = Depends(current_user)
+    user: User = Depends(current_user),
+    db: Database = Depends(get_db),
 ):
     """
     Retorna los mensajes del chat especificado por chat_id con paginación.
     Primero verifica que el usuario autenticado sea miembro del chat.
     """
-    db = Database()
-    user_id = _extract_user_id(user)
+    user_id = user.user_id
 
-    if not _user_is_member(db, chat_id, user_id):
+    # La membresía y la página de mensajes se consultan en paralelo (cada
+    # hilo con su conexión); si no es miembro, los mensajes se descartan.
+    is_member, (messages, meta) = await asyncio.gather(
+        run_in_threadpool(_user_is_member, db, chat_id, user_id),
+        run_in_threadpool(fetch_chat_messages, db, chat_id, limit, older_cursor),
+    )
+    if not is_member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="No tienes permiso para acceder a este chat.",
         )
 
-    messages, meta = fetch_chat_messages(db, chat_id, limit, older_cursor)
-    return {
+    return ORJSONResponse({
         "chat_id": chat_id,
         "messages": messages,
         "pagination": meta.model_dump(),
-    }
+    })
 
 
-def _user_is_member(db: Database, chat_id: int, user_id: int) -> bool:
-    membership_rows = db.fetch_query(
-        """
+MEMBERSHIP_QUERY = """
+    SELECT EXISTS (
         SELECT 1
         FROM chat_members
         WHERE chat_id = ? AND user_id = ?
-        LIMIT 1
-        """,
-        (chat_id, user_id),
-    )
-    return bool(membership_rows)
+    ) AS is_member
+"""
+
+
+def _user_is_member(db: Database, chat_id: int, user_id: int) -> bool:
+    cache_key = (chat_id, user_id)
+    with _membership_cache_lock:
+        cached = _membership_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    membership_rows = db.fetch_query(MEMBERSHIP_QUERY, (chat_id, user_id))
+    if membership_rows is None:
+        # Error de base de datos: no se guarda en caché.
+        return False
+    is_member = bool(membership_rows[0]["is_member"])
+    with _membership_cache_lock:
+        _membership_cache[cache_key] = is_member
+    return is_member
+
+
+def invalidate_membership(chat_id: int, *user_ids: int) -> None:
+    # Debe llamarse siempre que cambien los miembros de un chat.
+    with _membership_cache_lock:
+        for user_id in user_ids:
+            _membership_cache.pop((chat_id, user_id), None)
@@ -6,73 +6,179 @@ Router that manages requests, routing, and managing files, images, videos, etc..
 
 from __future__ import annotations
 
+import json
+import logging
 import os
+import stat
+from contextlib import suppress
+from functools import partial
 from pathlib import Path
-from typing import Dict, List
 
 from fastapi import (
     APIRouter,
+    BackgroundTasks,
     Depends,
     File,
     HTTPException,
+    Request,
+    Response,
     UploadFile,
     status,
 )
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, ORJSONResponse
 
 from routers.auth import User, current_user
-from routers.chats import create_message, _user_is_member as ensure_chat_membership
-from routers.websocket import notify_new_message
-from database.singleton import Database
+from routers.chats import (
+    create_message,
+    safe_notify_new_message,
+    _user_is_member as ensure_chat_membership,
+)
+from routers.websocket import redis_async
+from database.singleton import Database, get_db
 from database.attachments import (
     create_attachment_record,
     fetch_attachment_by_id,
     fetch_chat_attachments,
     serialize_attachment,
 )
-from static.protected.fileManager import ChatAttachmentManager
+from static.protected.fileManager import (
+    ChatAttachmentManager,
+    getAccelRedirect,
+    getCacheValidators,
+    getContentDisposition,
+    isNotModified,
+    spoolUpload,
+)
 
 router_files: APIRouter = APIRouter(prefix="/files", tags=["Files"])
 
 
 attachment_manager = ChatAttachmentManager()
 ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", 20 * 1024 * 1024))
+ATTACHMENT_META_CACHE_TTL = int(os.getenv("ATTACHMENT_META_CACHE_TTL", 300))
+FILE_CACHE_CONTROL = "private, max-age=300"
 
-
-def _extract_user_id(user: User) -> int:
-    user_id = getattr(user, "user_id", None)
-    if user_id is None:
-        user_id = getattr(user, "iD", None)
-    if user_id is None:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="No fue posible determinar el identificador del usuario autenticado.",
-        )
-    return user_id
+logger = logging.getLogger(__name__)
 
 
 def _build_attachment_payload(row: dict) -> dict:
     return serialize_attachment(row)
 
 
+def _attachment_meta_key(attachment_id: int) -> str:
+    return f"att:{attachment_id}"
+
+
+def _attachment_file_path(relative_path: str) -> Path | None:
+    # Reconstruye la ruta absoluta a partir de root y la ruta relativa de la
+    # fila, solo con texto (sin syscalls). La caché guarda la ruta relativa,
+    # nunca la absoluta: una entrada vieja o manipulada no puede apuntar
+    # fuera de la raíz protegida.
+    if not relative_path or os.path.isabs(relative_path):
+        return None
+    normalized = os.path.normpath(relative_path)
+    if normalized == "." or normalized == ".." or normalized.startswith(".." + os.sep):
+        return None
+    return Path(os.path.join(str(attachment_manager.root), normalized))
+
+
+def _stat_attachment(relative_path: str) -> dict | None:
+    # Corre en el threadpool: resolve_relative_path (realpath de la carpeta)
+    # y el lstat tocan el disco. Lanza ValueError si la ruta sale de root y
+    # retorna None si el archivo no existe o no es un archivo regular (un
+    # enlace simbólico no se sirve).
+    file_path = attachment_manager.resolve_relative_path(relative_path)
+    try:
+        stat_result = os.lstat(file_path)
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+    return getCacheValidators(file_path, stat_result)
+
+
+async def _attachment_meta_cached(db: Database, attachment_id: int) -> dict | None:
+    # Retorna {"row": fila del adjunto, "validators": ETag/Last-Modified o
+    # None, "invalid_path": bool}. Los adjuntos no cambian después de
+    # creados, así que la fila y sus validadores se guardan en Redis y se
+    # evita la consulta y el stat().
+    key = _attachment_meta_key(attachment_id)
+    try:
+        cached = await redis_async.get(key)
+    except Exception as exc:
+        logger.debug("No se pudo leer la caché de adjuntos: %s", exc)
+        cached = None
+    if cached is not None:
+        meta = json.loads(cached)
+        if meta.get("validators"):
+            return meta
+
+    row = await run_in_threadpool(fetch_attachment_by_id, db, attachment_id)
+    if not row:
+        return None
+
+    try:
+        validators = await run_in_threadpool(_stat_attachment, row["file_name"])
+    except ValueError:
+        return {"row": row, "validators": None, "invalid_path": True}
+    if validators is None:
+        # Solo se guardan rutas válidas; los errores se resuelven sin caché.
+        return {"row": row, "validators": None, "invalid_path": False}
+
+    meta = {"row": row, "validators": validators, "invalid_path": False}
+    try:
+        await redis_async.setex(key, ATTACHMENT_META_CACHE_TTL, json.dumps(meta))
+    except Exception as exc:
+        logger.debug("No se pudo guardar la caché de adjuntos: %s", exc)
+    return meta
+
+
+
 @router_files.get("/ison")
 async def ison():
     return {"message": "Yeah! I'm on!"}
 
 
+def _discard_temp_file(path: str) -> None:
+    with suppress(FileNotFoundError):
+        os.unlink(path)
+
+
+def _create_attachment_message(
+    db: Database, chat_id: int, user_id: int, content: str, stored
+) -> tuple[dict, dict]:
+    # El mensaje y su adjunto se guardan en una sola transacción: si falla
+    # el registro del adjunto no queda un mensaje "[Archivo adjunto]" huérfano.
+    with db.transaction():
+        message = create_message(db, chat_id, user_id, content)
+        attachment_row = create_attachment_record(
+            db,
+            chat_id=chat_id,
+            message_id=message["message_id"],
+            sender_id=user_id,
+            file_name=stored.relative_path,
+            mime_type=stored.mime_type,
+            size_bytes=stored.size_bytes,
+            original_name=stored.original_filename,
+        )
+    return message, attachment_row
+
+
 @router_files.post(
     "/chats/{chat_id}/attachments",
     status_code=status.HTTP_201_CREATED,
 )
 async def upload_chat_attachment(
     chat_id: int,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     user: User = Depends(current_user),
+    db: Database = Depends(get_db),
 ):
-    db = Database()
-    user_id = _extract_user_id(user)
+    user_id = user.user_id
 
-    if not ensure_chat_membership(db, chat_id, user_id):
+    if not await run_in_threadpool(ensure_chat_membership, db, chat_id, user_id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="No tienes permiso para enviar archivos a este chat.",
@@ -84,56 +190,69 @@ async def upload_chat_attachment(
             detail="Debes proporcionar un archivo.",
         )
 
-    payload = await file.read(ATTACHMENT_MAX_BYTES + 1)
-    if len(payload) > ATTACHMENT_MAX_BYTES:
-        raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail="El archivo excede el tamaño máximo permitido.",
-        )
-    if not payload:
+    filename = file.filename or "archivo"
+    try:
+        attachment_manager.validate_attachment(filename, file.content_type)
+    except ValueError as exc:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="El archivo está vacío.",
-        )
+            detail=str(exc),
+        ) from exc
+
+    # El archivo se copia por bloques a una carpeta temporal, sin cargarlo
+    # completo en memoria, y al final se mueve (rename) a la carpeta del chat.
+    upload_folder = await run_in_threadpool(attachment_manager.upload_folder)
+    temp_path, total_bytes = await spoolUpload(file, upload_folder, ATTACHMENT_MAX_BYTES)
 
     try:
-        stored = attachment_manager.store_attachment(
-            chat_id=chat_id,
-            sender_id=user_id,
-            filename=file.filename or "archivo",
-            payload=payload,
-            content_type=file.content_type,
+        if total_bytes > ATTACHMENT_MAX_BYTES:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail="El archivo excede el tamaño máximo permitido.",
+            )
+        if not total_bytes:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="El archivo está vacío.",
+            )
+        stored = await run_in_threadpool(
+            partial(
+                attachment_manager.store_attachment_from_path,
+                chat_id=chat_id,
+                sender_id=user_id,
+                filename=filename,
+                source_path=temp_path,
+                content_type=file.content_type,
+            )
         )
     except ValueError as exc:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(exc),
         ) from exc
+    except HTTPException:
+        raise
     except Exception as exc:  # pragma: no cover - errores inesperados
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="No fue posible almacenar el archivo.",
         ) from exc
+    finally:
+        # Si el archivo no se movió a su destino, se elimina el temporal.
+        await run_in_threadpool(_discard_temp_file, temp_path)
 
     message_content = "[Archivo adjunto]"
     if file.filename:
         message_content = f"[Archivo adjunto] {file.filename}"
 
-    message = create_message(db, chat_id, user_id, message_content)
-
+    # Las escrituras corren en el threadpool: con busy_timeout una espera
+    # por el lock de SQLite no detiene el event loop.
     try:
-        attachment_row = create_attachment_record(
-            db,
-            chat_id=chat_id,
-            message_id=message["message_id"],
-            sender_id=user_id,
-            file_name=stored.relative_path,
-            mime_type=stored.mime_type,
-            size_bytes=stored.size_bytes,
-            original_name=stored.original_filename,
+        message, attachment_row = await run_in_threadpool(
+            _create_attachment_message, db, chat_id, user_id, message_content, stored
         )
     except Exception as exc:  # pragma: no cover - errores inesperados
-        attachment_manager.delete_attachment(stored.relative_path)
+        await run_in_threadpool(attachment_manager.delete_attachment, stored.relative_path)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="No se pudo registrar el adjunto en la base de datos.",
@@ -142,11 +261,8 @@ async def upload_chat_attachment(
     attachment_payload = _build_attachment_payload(attachment_row)
     message.setdefault("attachments", []).append(attachment_payload)
 
-    try:
-        await notify_new_message(message)
-    except Exception:
-        # Fallos en la notificación no deben revertir el envío del archivo
-        pass
+    # La notificación no debe retrasar ni revertir el envío del archivo.
+    background_tasks.add_task(safe_notify_new_message, message)
 
     return {
         "message": message,
@@ -154,13 +270,13 @@ async def upload_chat_attachment(
     }
 
 
-@router_files.get("/chats/{chat_id}/attachments")
-async def list_chat_attachments(
+@router_files.get("/chats/{chat_id}/attachments", response_model=None)
+def list_chat_attachments(
     chat_id: int,
     user: User = Depends(current_user),
-) -> Dict[str, List[dict]]:
-    db = Database()
-    user_id = _extract_user_id(user)
+    db: Database = Depends(get_db),
+) -> ORJSONResponse:
+    user_id = user.user_id
 
     if not ensure_chat_membership(db, chat_id, user_id):
         raise HTTPException(
@@ -170,25 +286,26 @@ async def list_chat_attachments(
 
     rows = fetch_chat_attachments(db, chat_id)
     payload = [_build_attachment_payload(row) for row in rows]
-    return {"attachments": payload}
+    return ORJSONResponse({"attachments": payload})
 
 
 @router_files.get("/attachments/{attachment_id}")
 async def get_attachment_metadata(
     attachment_id: int,
     user: User = Depends(current_user),
+    db: Database = Depends(get_db),
 ) -> dict:
-    db = Database()
-    user_id = _extract_user_id(user)
+    user_id = user.user_id
 
-    row = fetch_attachment_by_id(db, attachment_id)
-    if not row:
+    meta = await _attachment_meta_cached(db, attachment_id)
+    if not meta:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Adjunto no encontrado.",
         )
+    row = meta["row"]
 
-    if not ensure_chat_membership(db, row["chat_id"], user_id):
+    if not await run_in_threadpool(ensure_chat_membership, db, row["chat_id"], user_id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="No tienes permiso para acceder a este archivo.",
@@ -200,42 +317,63 @@ async def get_attachment_metadata(
 @router_files.get("/attachments/{attachment_id}/download")
 async def download_attachment(
     attachment_id: int,
+    request: Request,
     user: User = Depends(current_user),
+    db: Database = Depends(get_db),
 ):
-    db = Database()
-    user_id = _extract_user_id(user)
+    user_id = user.user_id
 
-    row = fetch_attachment_by_id(db, attachment_id)
-    if not row:
+    meta = await _attachment_meta_cached(db, attachment_id)
+    if not meta:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Adjunto no encontrado.",
         )
+    row = meta["row"]
 
-    if not ensure_chat_membership(db, row["chat_id"], user_id):
+    if not await run_in_threadpool(ensure_chat_membership, db, row["chat_id"], user_id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="No tienes permiso para descargar este archivo.",
         )
 
-    try:
-        file_path = attachment_manager.resolve_relative_path(row["file_name"])
-    except ValueError as exc:
+    file_path = _attachment_file_path(row["file_name"])
+    if meta.get("invalid_path") or file_path is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Ruta de archivo inválida.",
-        ) from exc
-
-    if not file_path.exists():
+        )
+    validators = meta["validators"]
+    if validators is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="El archivo ya no está disponible en el servidor.",
         )
+    cache_headers = {
+        "ETag": validators["etag"],
+        "Last-Modified": validators["last_modified"],
+        "Cache-Control": FILE_CACHE_CONTROL,
+    }
+    # Si el cliente ya tiene esta versión, no se envía el archivo.
+    if isNotModified(request.headers, **validators):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
 
     download_name = row.get("original_name") or Path(row["file_name"]).name
 
+    accel_path = getAccelRedirect(row["file_name"])
+    if accel_path:
+        return Response(
+            media_type=row["mime_type"],
+            headers={
+                **cache_headers,
+                "X-Accel-Redirect": accel_path,
+                "Content-Disposition": getContentDisposition(download_name),
+            },
+        )
+
     return FileResponse(
         path=file_path,
         media_type=row["mime_type"],
         filename=download_name,
+        headers=cache_headers,
     )
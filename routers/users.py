@@ -7,21 +7,49 @@ Other authenticated users can only read those images.
 
 from __future__ import annotations
 
+import hashlib
 import logging
 import mimetypes
 import os
+import re
+import time
+from contextlib import suppress
+from functools import lru_cache
+from pathlib import Path
+
+import aiofiles.os
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, ORJSONResponse
 
-from fastapi import APIRouter, Depends, File, HTTPException, Query, UploadFile, status
-from fastapi.responses import FileResponse
-
-from routers.auth import User, current_user
-from database.singleton import Database
+from routers.auth import User, current_user, invalidate_user_cache
+# Se comparte el cliente (y su pool de conexiones) del módulo de WebSockets.
+from routers.websocket import PRESENCE_ONLINE_KEY, redis_async as presence_redis
+from database.singleton import Database, get_db
 from database.users import (
     fetch_user_by_id,
     fetch_user_by_username,
-    update_user_profile_image,
+    replace_user_profile_image,
+)
+from static.protected.fileManager import (
+    ProfileImage,
+    getAccelRedirect,
+    getCacheValidators,
+    getContentDisposition,
+    isNotModified,
+    spoolUpload,
 )
-from static.protected.fileManager import ProfileImage
 import redis
 
 
@@ -30,24 +58,12 @@ router_users = APIRouter(prefix="/users", tags=["Users"])
 
 logger = logging.getLogger(__name__)
 
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 CONNECTION_TTL_SECONDS = int(os.getenv("WEBSOCKET_CONNECTION_TTL", "120"))
-presence_redis = redis.Redis.from_url(REDIS_URL, decode_responses=True)
 
 profile_image_manager = ProfileImage()
 PROFILE_IMAGE_MAX_BYTES = int(os.getenv("PROFILE_IMAGE_MAX_BYTES", 5 * 1024 * 1024))
-
-
-def _extract_user_id(user: User) -> int:
-    user_id = getattr(user, "user_id", None)
-    if user_id is None:
-        user_id = getattr(user, "iD", None)
-    if user_id is None:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="No fue posible determinar el identificador del usuario autenticado.",
-        )
-    return user_id
+AVATAR_CACHE_TTL = int(os.getenv("AVATAR_CACHE_TTL", 300))
+PROFILE_IMAGE_CACHE_CONTROL = "private, max-age=300"
 
 
 def _ensure_user(db: Database, user_id: int) -> dict:
@@ -80,12 +96,91 @@ def _normalize_username(value: str) -> str:
     return normalized
 
 
-def _serve_profile_image(relative_path: str) -> FileResponse:
+def _avatar_cache_key(user_id: int, relative_path: str) -> str:
+    # La ruta forma parte de la clave: al cambiar la imagen, la entrada
+    # anterior simplemente deja de usarse.
+    path_hash = hashlib.sha1(relative_path.encode("utf-8")).hexdigest()[:16]
+    return f"avatar:{user_id}:{path_hash}"
+
+
+async def _invalidate_avatar_cache(user_id: int, relative_path: str | None) -> None:
+    if not relative_path:
+        return
+    try:
+        await presence_redis.delete(_avatar_cache_key(user_id, relative_path))
+    except redis.RedisError as exc:
+        logger.debug("No se pudo invalidar la caché de avatares: %s", exc)
+
+
+def _profile_image_response(
+    request: Request,
+    relative_path: str,
+    image_path: Path,
+    media_type: str,
+    validators: dict,
+    stat_result: os.stat_result | None = None,
+):
+    cache_headers = {
+        "ETag": validators["etag"],
+        "Last-Modified": validators["last_modified"],
+        "Cache-Control": PROFILE_IMAGE_CACHE_CONTROL,
+    }
+    # Si el cliente ya tiene esta versión, no se envía la imagen.
+    if isNotModified(request.headers, validators["etag"], validators["last_modified"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+    accel_path = getAccelRedirect(relative_path)
+    if accel_path:
+        return Response(
+            media_type=media_type,
+            headers={
+                **cache_headers,
+                "X-Accel-Redirect": accel_path,
+                "Content-Disposition": getContentDisposition(image_path.name),
+            },
+        )
+    # Con stat_result, FileResponse no vuelve a hacer stat() del archivo.
+    return FileResponse(
+        path=image_path,
+        media_type=media_type,
+        filename=image_path.name,
+        headers=cache_headers,
+        stat_result=stat_result,
+    )
+
+
+# Campos del hash de caché de un avatar; se leen con HMGET en este orden.
+AVATAR_CACHE_FIELDS = ("path", "media_type", "etag", "last_modified")
+
+
+@lru_cache(maxsize=32)
+def _media_type_for(suffix: str) -> str:
+    media_type, _ = mimetypes.guess_type(f"avatar{suffix}")
+    return media_type or "image/png"
+
+
+async def _serve_profile_image(request: Request, record: dict):
+    relative_path = record.get("profile_image")
     if not relative_path:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Este usuario no tiene una imagen de perfil configurada.",
         )
+
+    # Redis guarda la ruta absoluta, el tipo MIME y los validadores (ETag,
+    # Last-Modified) ya calculados para no repetir resolve() + stat() en
+    # cada render de la imagen de perfil.
+    cache_key = _avatar_cache_key(record["user_id"], relative_path)
+    try:
+        values = await presence_redis.hmget(cache_key, AVATAR_CACHE_FIELDS)
+    except redis.RedisError as exc:
+        logger.debug("No se pudo leer la caché de avatares: %s", exc)
+        values = None
+    if values and all(value is not None for value in values):
+        cached = dict(zip(AVATAR_CACHE_FIELDS, values))
+        return _profile_image_response(
+            request, relative_path, Path(cached["path"]), cached["media_type"], cached
+        )
+
     try:
         image_path = profile_image_manager.resolve_relative_path(relative_path)
     except ValueError as exc:
@@ -94,17 +189,33 @@ def _serve_profile_image(relative_path: str) -> FileResponse:
             detail="Ruta de imagen almacenada inválida.",
         ) from exc
 
-    if not image_path.exists():
+    try:
+        stat_result = os.stat(image_path)
+    except FileNotFoundError as exc:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="La imagen de perfil ya no está disponible en el servidor.",
+        ) from exc
+    validators = getCacheValidators(image_path, stat_result)
+
+    # El tipo MIME se guarda al subir el avatar; los registros anteriores a
+    # la columna profile_image_mime lo deducen de la extensión.
+    media_type = record.get("profile_image_mime")
+    if not media_type:
+        media_type = _media_type_for(image_path.suffix.lower())
+    try:
+        pipe = presence_redis.pipeline(transaction=False)
+        pipe.hset(
+            cache_key,
+            mapping={"path": str(image_path), "media_type": media_type, **validators},
         )
+        pipe.expire(cache_key, AVATAR_CACHE_TTL)
+        await pipe.execute()
+    except redis.RedisError as exc:
+        logger.debug("No se pudo guardar la caché de avatares: %s", exc)
 
-    media_type, _ = mimetypes.guess_type(image_path.name)
-    return FileResponse(
-        path=image_path,
-        media_type=media_type or "image/png",
-        filename=image_path.name,
+    return _profile_image_response(
+        request, relative_path, image_path, media_type, validators, stat_result
     )
 
 
@@ -112,14 +223,7 @@ def _presence_key(user_id: int) -> str:
     return f"connection:{user_id}"
 
 
-def _read_presence(user_id: int) -> dict:
-    key = _presence_key(user_id)
-    try:
-        record = presence_redis.hgetall(key)
-    except Exception as exc:
-        logger.debug("No fue posible leer el estado de usuario %s: %s", user_id, exc)
-        record = {}
-
+def _build_presence(record: dict | None, ttl_raw) -> dict:
     status_value = record.get("status") if record else None
     status = status_value or "disconnected"
     last_seen = record.get("last_seen") if record else None
@@ -131,13 +235,8 @@ def _read_presence(user_id: int) -> dict:
         connection_count = 0
 
     ttl_seconds: int | None = None
-    try:
-        ttl_raw = presence_redis.ttl(key)
-    except Exception as exc:
-        logger.debug("No fue posible obtener el TTL de la presencia %s: %s", user_id, exc)
-    else:
-        if isinstance(ttl_raw, int) and ttl_raw >= 0:
-            ttl_seconds = ttl_raw
+    if isinstance(ttl_raw, int) and ttl_raw >= 0:
+        ttl_seconds = ttl_raw
 
     return {
         "status": status,
@@ -147,63 +246,126 @@ def _read_presence(user_id: int) -> dict:
     }
 
 
-@router_users.get("/status")
+async def _read_presence(user_id: int) -> dict:
+    return (await _read_presence_bulk([user_id]))[user_id]
+
+
+PRESENCE_FIELDS = ("status", "last_seen", "connection_count")
+
+
+async def _read_presence_bulk(user_ids: list[int]) -> dict[int, dict]:
+    # Un ZMSCORE sobre el ZSET de presencia indica qué usuarios siguen vivos
+    # y su TTL restante; solo para esos se leen los datos del hash (HMGET en
+    # un pipeline). Los demás se reportan como desconectados.
+    presences: dict[int, dict] = {user_id: _build_presence(None, None) for user_id in user_ids}
+    if not user_ids:
+        return presences
+
+    now = time.time()
+    try:
+        scores = await presence_redis.zmscore(PRESENCE_ONLINE_KEY, user_ids)
+        alive = [
+            (user_id, int(score - now))
+            for user_id, score in zip(user_ids, scores)
+            if score is not None and score >= now
+        ]
+        if alive:
+            pipe = presence_redis.pipeline(transaction=False)
+            for user_id, _ in alive:
+                pipe.hmget(_presence_key(user_id), PRESENCE_FIELDS)
+            records = await pipe.execute()
+            for (user_id, ttl_seconds), values in zip(alive, records):
+                record = dict(zip(PRESENCE_FIELDS, values))
+                if record["status"] is not None:
+                    presences[user_id] = _build_presence(record, ttl_seconds)
+    except Exception as exc:
+        logger.debug("No fue posible leer el estado de los usuarios %s: %s", user_ids, exc)
+
+    return presences
+
+
+# Lista de ids separados por comas; se permiten espacios y segmentos vacíos.
+# Solo dígitos ASCII (sin signo) y a lo más USER_ID_MAX_DIGITS por id, así un
+# id enorme no llega a int() ni a SQLite.
+USER_ID_MAX_DIGITS = 18
+USER_IDS_PATTERN = re.compile(
+    rf"\s*(?:[0-9]{{1,{USER_ID_MAX_DIGITS}}}\s*)?(?:,\s*(?:[0-9]{{1,{USER_ID_MAX_DIGITS}}}\s*)?)*"
+)
+USER_ID_TOKEN = re.compile(r"[0-9]+")
+MAX_STATUS_IDS = int(os.getenv("MAX_STATUS_IDS", 200))
+
+
+@router_users.get("/status", response_model=None)
 async def get_users_status(
     ids: str = Query(..., description="Lista separada por comas de identificadores de usuario."),
     user: User = Depends(current_user),
 ):
-    db = Database()
-    _ensure_user(db, _extract_user_id(user))
-
-    tokens = [segment.strip() for segment in (ids or "").split(",") if segment.strip()]
-    if not tokens:
+    # Camino rápido: si toda la cadena es válida se valida con una sola
+    # expresión regular y los números se convierten con map(int, ...).
+    ids = ids or ""
+    target_ids: set[int] | None = None
+    if USER_IDS_PATTERN.fullmatch(ids):
+        try:
+            target_ids = set(map(int, USER_ID_TOKEN.findall(ids)))
+        except ValueError:
+            target_ids = None
+    if target_ids is None:
+        invalid_tokens = [
+            token[:32]
+            for token in (segment.strip() for segment in ids.split(","))
+            if token
+            and not (token.isascii() and token.isdigit() and len(token) <= USER_ID_MAX_DIGITS)
+        ]
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Debes proporcionar al menos un identificador válido en 'ids'.",
+            detail=f"Identificadores inválidos: {', '.join(invalid_tokens)}.",
         )
 
-    target_ids: set[int] = set()
-    invalid_tokens: list[str] = []
-    for token in tokens:
-        try:
-            target_ids.add(int(token))
-        except ValueError:
-            invalid_tokens.append(token)
+    if len(target_ids) > MAX_STATUS_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Se permiten a lo más {MAX_STATUS_IDS} identificadores en 'ids'.",
+        )
 
-    if invalid_tokens:
+    if not target_ids:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Identificadores inválidos: {', '.join(invalid_tokens)}.",
+            detail="Debes proporcionar al menos un identificador válido en 'ids'.",
         )
 
-    statuses = {target_id: _read_presence(target_id) for target_id in sorted(target_ids)}
-    return {"users": statuses}
+    statuses = await _read_presence_bulk(sorted(target_ids))
+    return ORJSONResponse({"users": statuses})
 
 
 @router_users.get("/{target_user_id}/status")
 async def get_user_status(
     target_user_id: int,
     user: User = Depends(current_user),
+    db: Database = Depends(get_db),
 ):
-    db = Database()
-    _ensure_user(db, _extract_user_id(user))
-    # Retorna 404 si el usuario objetivo no existe.
-    _ensure_user(db, target_user_id)
-    return _read_presence(target_user_id)
+    # Retorna 404 si el usuario objetivo no existe; el JWT válido basta
+    # para autenticar a quien consulta.
+    await run_in_threadpool(_ensure_user, db, target_user_id)
+    return await _read_presence(target_user_id)
 
 
 @router_users.get("/me/avatar")
-async def get_my_profile_image(user: User = Depends(current_user)):
-    db = Database()
-    user_id = _extract_user_id(user)
-    record = _ensure_user(db, user_id)
-    return _serve_profile_image(record.get("profile_image"))
+async def get_my_profile_image(
+    request: Request,
+    user: User = Depends(current_user),
+    db: Database = Depends(get_db),
+):
+    # La imagen se lee de la base y no del User autenticado: ese viene de la
+    # caché de tokens y puede tener una ruta ya reemplazada o borrada.
+    record = await run_in_threadpool(_ensure_user, db, user.user_id)
+    return await _serve_profile_image(request, record)
 
 
 @router_users.put("/me/avatar", status_code=status.HTTP_200_OK)
 async def update_my_profile_image(
     file: UploadFile = File(...),
     user: User = Depends(current_user),
+    db: Database = Depends(get_db),
 ):
     if file is None:
         raise HTTPException(
@@ -211,51 +373,65 @@ async def update_my_profile_image(
             detail="Debes proporcionar una imagen válida.",
         )
 
-    payload = await file.read(PROFILE_IMAGE_MAX_BYTES + 1)
-    if len(payload) == 0:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="El archivo está vacío.",
-        )
-    if len(payload) > PROFILE_IMAGE_MAX_BYTES:
-        raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail="La imagen excede el tamaño máximo permitido.",
-        )
-
-    db = Database()
-    user_id = _extract_user_id(user)
-    record = _ensure_user(db, user_id)
-    previous_path = record.get("profile_image")
-
+    # La imagen se copia por bloques a un temporal y Pillow la lee desde
+    # disco, en lugar de mantener todo el archivo en memoria.
+    upload_folder = await run_in_threadpool(profile_image_manager.upload_folder)
+    temp_path, total_bytes = await spoolUpload(file, upload_folder, PROFILE_IMAGE_MAX_BYTES)
     try:
-        stored = profile_image_manager.createProfileImage(
-            payload,
-            user_id=user_id,
-            filename=file.filename,
-        )
-    except RuntimeError as exc:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="No fue posible procesar la imagen de perfil.",
-        ) from exc
-    except Exception as exc:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=str(exc),
-        ) from exc
+        if total_bytes == 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="El archivo está vacío.",
+            )
+        if total_bytes > PROFILE_IMAGE_MAX_BYTES:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail="La imagen excede el tamaño máximo permitido.",
+            )
+
+        user_id = user.user_id
+        try:
+            stored = await profile_image_manager.createProfileImageAsync(
+                Path(temp_path),
+                user_id=user_id,
+                filename=file.filename,
+            )
+        except RuntimeError as exc:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="No fue posible procesar la imagen de perfil.",
+            ) from exc
+        except Exception as exc:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(exc),
+            ) from exc
+    finally:
+        with suppress(FileNotFoundError):
+            await aiofiles.os.remove(temp_path)
 
     try:
-        update_user_profile_image(db, user_id, stored.relative_path)
+        mime_type, _ = mimetypes.guess_type(stored.filename)
+        found, previous_path = await run_in_threadpool(
+            replace_user_profile_image, db, user_id, stored.relative_path, mime_type
+        )
     except Exception as exc:
-        profile_image_manager.delete_profile_image(stored.relative_path)
+        await profile_image_manager.delete_profile_image_async(stored.relative_path)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="No fue posible actualizar la imagen de perfil.",
         ) from exc
+    if not found:
+        await profile_image_manager.delete_profile_image_async(stored.relative_path)
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Usuario no encontrado.",
+        )
+    invalidate_user_cache(user_id)
 
     if previous_path and previous_path != stored.relative_path:
-        profile_image_manager.delete_profile_image(previous_path)
+        await _invalidate_avatar_cache(user_id, previous_path)
+        await profile_image_manager.delete_profile_image_async(previous_path)
 
     return {
         "profile_image": stored.relative_path,
@@ -264,47 +440,55 @@ async def update_my_profile_image(
 
 
 @router_users.delete("/me/avatar", status_code=status.HTTP_200_OK)
-async def delete_my_profile_image(user: User = Depends(current_user)):
-    db = Database()
-    user_id = _extract_user_id(user)
-    record = _ensure_user(db, user_id)
-    relative_path = record.get("profile_image")
-    if not relative_path:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="No tienes una imagen de perfil configurada.",
-        )
-
+async def delete_my_profile_image(
+    user: User = Depends(current_user),
+    db: Database = Depends(get_db),
+):
+    user_id = user.user_id
     try:
-        update_user_profile_image(db, user_id, None)
+        found, relative_path = await run_in_threadpool(
+            replace_user_profile_image, db, user_id, None
+        )
     except Exception as exc:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="No fue posible eliminar la imagen de perfil.",
         ) from exc
+    if not found:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Usuario no encontrado.",
+        )
+    if not relative_path:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No tienes una imagen de perfil configurada.",
+        )
+    invalidate_user_cache(user_id)
+    await _invalidate_avatar_cache(user_id, relative_path)
 
-    profile_image_manager.delete_profile_image(relative_path)
+    await profile_image_manager.delete_profile_image_async(relative_path)
     return {"detail": "Imagen de perfil eliminada correctamente."}
 
 
 @router_users.get("/{target_user_id}/avatar")
 async def get_user_profile_image(
     target_user_id: int,
+    request: Request,
     user: User = Depends(current_user),
+    db: Database = Depends(get_db),
 ):
-    db = Database()
-    _ensure_user(db, _extract_user_id(user))
-    record = _ensure_user(db, target_user_id)
-    return _serve_profile_image(record.get("profile_image"))
+    record = await run_in_threadpool(_ensure_user, db, target_user_id)
+    return await _serve_profile_image(request, record)
 
 
 @router_users.get("/by-username/{target_username}/avatar")
 async def get_user_profile_image_by_username(
     target_username: str,
+    request: Request,
     user: User = Depends(current_user),
+    db: Database = Depends(get_db),
 ):
-    db = Database()
-    _ensure_user(db, _extract_user_id(user))
     normalized_username = _normalize_username(target_username)
-    record = _ensure_user_by_username(db, normalized_username)
-    return _serve_profile_image(record.get("profile_image"))
+    record = await run_in_threadpool(_ensure_user_by_username, db, normalized_username)
+    return await _serve_profile_image(request, record)
@@ -8,17 +8,20 @@ broadcasts updates to connected clients.
 from __future__ import annotations
 
 import asyncio
-import json
+import heapq
+import itertools
 import os
 from collections import defaultdict
 from contextlib import suppress
 import logging
 import time
 from dataclasses import dataclass, field
+from functools import partial
 from datetime import datetime, timezone
-from typing import Any, Dict, Set
+from typing import Any, Awaitable, Callable, Dict, Set
 import uuid
 
+import orjson
 from fastapi import (
     APIRouter,
     Depends,
@@ -29,16 +32,13 @@ from fastapi import (
     status,
 )
 from dotenv import load_dotenv
-import redis
 from redis.asyncio import Redis as AsyncRedis
-from jose import JWTError, jwt
+from jose import JWTError
 
 from routers.auth import (
-    ALGORITHM,
-    SECRET,
     User,
+    authenticate_token,
     current_user,
-    search_user,
 )
 from database.singleton import Database
 
@@ -49,83 +49,186 @@ router_websockets = APIRouter(prefix="/websockets")
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 PUBSUB_CHANNEL = os.getenv("CHAT_PUBSUB_CHANNEL", "chat_events")
 
-redis_sync = redis.Redis.from_url(REDIS_URL, decode_responses=True)
-redis_async = AsyncRedis.from_url(REDIS_URL, decode_responses=True)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+# Único cliente Redis del proceso (lo reutilizan chats, files y users). Es
+# asíncrono para no bloquear el event loop y su pool acotado reutiliza las
+# conexiones TCP en lugar de abrir una por llamada.
+redis_async = AsyncRedis.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    max_connections=REDIS_MAX_CONNECTIONS,
+)
+# Cliente aparte, con su propio pool, para el listener de pub/sub: su
+# conexión queda tomada mientras dure la suscripción y así no compite con
+# los comandos ni falla si el pool de redis_async está agotado.
+redis_pubsub = AsyncRedis.from_url(REDIS_URL, decode_responses=True, max_connections=1)
 
 PROCESS_ID = f"{os.getpid()}-{uuid.uuid4().hex}"
+# Inicio del JSON de los eventos publicados por este proceso.
+OWN_EVENT_PREFIX = f'{{"origin":"{PROCESS_ID}"'
 CONNECTION_TTL_SECONDS = int(os.getenv("WEBSOCKET_CONNECTION_TTL", "120"))
 HEARTBEAT_INTERVAL = int(os.getenv("WEBSOCKET_HEARTBEAT_INTERVAL", "30"))
 IDLE_TIMEOUT = int(os.getenv("WEBSOCKET_IDLE_TIMEOUT", "90"))
 PRESENCE_TOUCH_INTERVAL = int(os.getenv("WEBSOCKET_PRESENCE_TOUCH_INTERVAL", "15"))
+# Ventana en la que se juntan los cambios de estado de un mismo usuario.
+STATUS_DEBOUNCE_DELAY = float(os.getenv("WEBSOCKET_STATUS_DEBOUNCE_DELAY", "0.25"))
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("WEBSOCKET_PRESENCE_FLUSH_INTERVAL", "0.05"))
+# Segundos que se espera antes de marcar como desconectado a un usuario que
+# cerró su último socket; 0 desactiva la espera.
+PRESENCE_DISCONNECT_DELAY = float(os.getenv("WEBSOCKET_PRESENCE_DISCONNECT_DELAY", "0.5"))
+MESSAGE_WRITE_QUEUE_SIZE = int(os.getenv("WEBSOCKET_MESSAGE_QUEUE_SIZE", "1024"))
+MESSAGE_WRITE_BATCH = int(os.getenv("WEBSOCKET_MESSAGE_BATCH", "64"))
+PUBSUB_POLL_TIMEOUT = float(os.getenv("REDIS_PUBSUB_POLL_TIMEOUT", "1.0"))
+PUBSUB_BATCH_SIZE = int(os.getenv("REDIS_PUBSUB_BATCH_SIZE", "256"))
+SOCKET_SEND_QUEUE_SIZE = int(os.getenv("WEBSOCKET_SEND_QUEUE_SIZE", "64"))
+PUBLISH_QUEUE_SIZE = int(os.getenv("REDIS_PUBLISH_QUEUE_SIZE", "10000"))
+PUBLISH_BATCH_SIZE = int(os.getenv("REDIS_PUBLISH_BATCH_SIZE", "100"))
+PUBLISH_FLUSH_INTERVAL = float(os.getenv("REDIS_PUBLISH_FLUSH_INTERVAL", "0.005"))
 
 
 def _membership_key(user_id: int) -> str:
     return f"connection:{user_id}"
 
+
+# ZSET con todos los usuarios con presencia vigente; el score es el epoch en
+# que expira su conexión. Con un solo ZMSCORE se sabe si cada usuario sigue
+# vivo y cuánto TTL le queda, sin consultar el hash de cada uno.
+PRESENCE_ONLINE_KEY = "presence:online"
+
+
+def _queue_presence_expiry(pipe, user_id: int) -> None:
+    # Agrega al pipeline la renovación del TTL del hash y del score del ZSET.
+    pipe.expire(_membership_key(user_id), CONNECTION_TTL_SECONDS)
+    pipe.zadd(PRESENCE_ONLINE_KEY, {str(user_id): time.time() + CONNECTION_TTL_SECONDS})
+
 logger = logging.getLogger(__name__)
 
 
-def _utcnow_iso() -> str:
-    return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+# Última marca de tiempo formateada: (milisegundo epoch, texto). Las
+# llamadas dentro del mismo milisegundo reutilizan el texto sin volver a
+# formatear.
+_iso_cache: tuple[int, str] = (-1, "")
+# Prefijo "YYYY-MM-DDT" del día UTC en curso: (día epoch, texto). Solo se
+# recalcula con datetime al cambiar de día.
+_iso_date_cache: tuple[int, str] = (-1, "")
 
 
-async def _presence_touch(user_id: int) -> None:
-    key = _membership_key(user_id)
+def _utcnow_iso() -> str:
+    global _iso_cache, _iso_date_cache
+    millisecond = time.time_ns() // 1_000_000
+    cached_millisecond, cached = _iso_cache
+    if millisecond == cached_millisecond:
+        return cached
+    seconds, remainder = divmod(millisecond, 1000)
+    day, second_of_day = divmod(seconds, 86400)
+    cached_day, date_prefix = _iso_date_cache
+    if day != cached_day:
+        date_prefix = datetime.fromtimestamp(day * 86400, timezone.utc).strftime("%Y-%m-%dT")
+        _iso_date_cache = (day, date_prefix)
+    hours, rest = divmod(second_of_day, 3600)
+    minutes, secs = divmod(rest, 60)
+    formatted = f"{date_prefix}{hours:02d}:{minutes:02d}:{secs:02d}.{remainder:03d}Z"
+    _iso_cache = (millisecond, formatted)
+    return formatted
+
+
+async def _presence_touch_many(user_ids: Set[int]) -> None:
+    # Refresca last_seen y los TTL de varios usuarios en un solo round-trip.
     timestamp = _utcnow_iso()
     try:
-        pipe = redis_async.pipeline()
-        pipe.hset(key, mapping={"last_seen": timestamp})
-        pipe.expire(key, CONNECTION_TTL_SECONDS)
+        pipe = redis_async.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hset(_membership_key(user_id), mapping={"last_seen": timestamp})
+            _queue_presence_expiry(pipe, user_id)
         await pipe.execute()
     except Exception as exc:
-        logger.debug("No se pudo refrescar la presencia del usuario %s: %s", user_id, exc)
+        logger.debug("No se pudo refrescar la presencia de %s usuarios: %s", len(user_ids), exc)
+
+
+# Transición de presencia (conexión o desconexión) atómica y en un solo
+# round-trip: ajusta el contador (nunca por debajo de 0), el estado depende
+# de las conexiones restantes, escribe los campos extra, renueva los TTL y,
+# al desconectar, limpia del ZSET a los usuarios cuya presencia ya expiró.
+# KEYS: hash de conexión, ZSET de presencia.
+# ARGV: delta, estado si no quedan conexiones, TTL, user_id, expiración en el
+# ZSET, epoch actual, y luego pares campo/valor para el hash.
+_presence_transition_script = redis_async.register_script(
+    """
+    local delta = tonumber(ARGV[1])
+    local count = redis.call('HINCRBY', KEYS[1], 'connection_count', delta)
+    if count < 0 then
+        count = 0
+        redis.call('HSET', KEYS[1], 'connection_count', 0)
+    end
+    local status = ARGV[2]
+    if count > 0 then
+        status = 'connected'
+    end
+    redis.call('HSET', KEYS[1], 'status', status, unpack(ARGV, 7))
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('ZADD', KEYS[2], ARGV[5], ARGV[4])
+    if delta < 0 then
+        redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[6])
+    end
+    return {count, status}
+    """
+)
+
+
+async def _presence_transition(
+    user_id: int, delta: int, fallback_status: str, fields: Dict[str, str]
+) -> tuple[int, str]:
+    now = time.time()
+    args: list[Any] = [
+        delta,
+        fallback_status,
+        CONNECTION_TTL_SECONDS,
+        user_id,
+        now + CONNECTION_TTL_SECONDS,
+        now,
+    ]
+    for name, value in fields.items():
+        args.extend((name, value))
+    connection_count, status = await _presence_transition_script(
+        keys=[_membership_key(user_id), PRESENCE_ONLINE_KEY], args=args
+    )
+    return int(connection_count), status
 
 
 async def _presence_increment(user: User) -> Dict[str, Any]:
-    key = _membership_key(user.user_id)
     timestamp = _utcnow_iso()
-    payload = {
-        "status": "connected",
-        "username": user.username,
-        "name": user.name or "",
-        "email": user.email or "",
-        "last_seen": timestamp,
-    }
+    status = "connected"
     connection_count: int | None = None
     try:
-        connection_count = await redis_async.hincrby(key, "connection_count", 1)
-        await redis_async.hset(key, mapping=payload)
-        await redis_async.expire(key, CONNECTION_TTL_SECONDS)
+        connection_count, status = await _presence_transition(
+            user.user_id,
+            1,
+            status,
+            {
+                "username": user.username,
+                "name": user.name or "",
+                "email": user.email or "",
+                "last_seen": timestamp,
+            },
+        )
     except Exception as exc:
         logger.warning("No se pudo registrar la conexión WebSocket para %s: %s", user.user_id, exc)
         connection_count = None
     return {
-        "status": payload["status"],
+        "status": status,
         "last_seen": timestamp,
         "connection_count": connection_count,
     }
 
 
 async def _presence_decrement(user_id: int, *, fallback_status: str) -> Dict[str, Any]:
-    key = _membership_key(user_id)
     timestamp = _utcnow_iso()
     status = fallback_status
     connection_count: int | None = None
     try:
-        connection_count = await redis_async.hincrby(key, "connection_count", -1)
-        if connection_count < 0:
-            connection_count = 0
-            await redis_async.hset(key, "connection_count", 0)
-        if connection_count > 0:
-            status = "connected"
-        await redis_async.hset(
-            key,
-            mapping={
-                "status": status,
-                "last_seen": timestamp,
-            },
+        connection_count, status = await _presence_transition(
+            user_id, -1, fallback_status, {"last_seen": timestamp}
         )
-        await redis_async.expire(key, CONNECTION_TTL_SECONDS)
     except Exception as exc:
         logger.warning("No se pudo registrar la desconexión de %s: %s", user_id, exc)
         connection_count = None
@@ -146,14 +249,49 @@ def _presence_event(user_id: int, presence: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
+def _encode_event(event: Dict[str, Any]) -> str:
+    # orjson produce el mismo JSON compacto en UTF-8 que WebSocket.send_json.
+    return orjson.dumps(event).decode("utf-8")
+
+
+def _text_frame(text: str) -> Dict[str, str]:
+    # Mensaje ASGI ya armado: el mismo dict sirve para todos los
+    # destinatarios de un broadcast y se envía con WebSocket.send, sin pasar
+    # por send_text para cada socket.
+    return {"type": "websocket.send", "text": text}
+
+
+async def _send_event(websocket: WebSocket, event: Dict[str, Any]) -> None:
+    # Reemplazo de websocket.send_json que serializa con orjson.
+    await websocket.send_text(_encode_event(event))
+
+
 @dataclass
 class ConnectionState:
     websocket: WebSocket
+    user_id: int
+    conn_id: int
     last_activity: float = field(default_factory=time.monotonic)
     last_presence_refresh: float = field(default_factory=lambda: 0.0)
     pending_ping_id: str | None = None
-    heartbeat_task: asyncio.Task | None = None
+    # Próximo heartbeat programado; identifica la entrada vigente del heap.
+    heartbeat_deadline: float = 0.0
     disconnect_status: str = "disconnected"
+    # Frames de broadcast pendientes; los envía sender_task, de modo que un
+    # cliente lento no retrasa el broadcast a los demás.
+    send_queue: asyncio.Queue = field(
+        default_factory=lambda: asyncio.Queue(maxsize=SOCKET_SEND_QUEUE_SIZE)
+    )
+    sender_task: asyncio.Task | None = None
+
+    def enqueue(self, frame: Dict[str, str]) -> None:
+        # Si la cola está llena se descarta el frame más antiguo.
+        try:
+            self.send_queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            with suppress(asyncio.QueueEmpty):
+                self.send_queue.get_nowait()
+            self.send_queue.put_nowait(frame)
 
 
 class ConnectionManager:
@@ -163,233 +301,542 @@ class ConnectionManager:
     pub/sub listener per process.
     """
 
-    def __init__(self) -> None:
-        self._connections: Dict[int, Dict[int, ConnectionState]] = {}
+    def __init__(
+        self, redis_client: AsyncRedis = redis_async, pubsub_client: AsyncRedis = redis_pubsub
+    ) -> None:
+        # No hay lock: todo corre en el hilo del event loop y ningún método
+        # hace await entre leer y modificar estas estructuras, así que cada
+        # actualización es atómica respecto a las demás corrutinas.
+        self._redis = redis_client
+        self._pubsub_redis = pubsub_client
+        # Estado de cada conexión por conn_id (un entero asignado en connect)
+        # y los conn_id abiertos de cada usuario.
+        self._states: Dict[int, ConnectionState] = {}
+        self._user_conns: Dict[int, Set[int]] = {}
+        self._conn_counter = itertools.count(1)
         self._subscriptions: Dict[int, Set[int]] = defaultdict(set)
-        self._lock = asyncio.Lock()
+        # Índice inverso chat_id -> {conn_id: ConnectionState}: el
+        # broadcast de un chat obtiene sus destinatarios sin recorrer a todos
+        # los usuarios conectados.
+        self._chat_members: Dict[int, Dict[int, ConnectionState]] = {}
+        # Chats cuya membresía ya se validó en la base de datos para cada
+        # usuario conectado; evita repetir el SELECT en cada mensaje.
+        self._verified_membership: Dict[int, Set[int]] = defaultdict(set)
         self._listener_task: asyncio.Task | None = None
-
-    async def connect(self, user_id: int, websocket: WebSocket) -> None:
-        async with self._lock:
-            user_connections = self._connections.setdefault(user_id, {})
-            state = ConnectionState(websocket=websocket)
-            user_connections[id(websocket)] = state
-            self._subscriptions.setdefault(user_id, set())
-        state.heartbeat_task = asyncio.create_task(self._heartbeat_loop(user_id, id(websocket)))
+        # Cola de mensajes por guardar: un solo task los inserta por lotes
+        # fuera del event loop, con un commit por lote.
+        self._write_queue: asyncio.Queue = asyncio.Queue(maxsize=MESSAGE_WRITE_QUEUE_SIZE)
+        self._writer_task: asyncio.Task | None = None
+        # Eventos ya serializados pendientes de publicar en Redis.
+        self._publish_queue: asyncio.Queue = asyncio.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+        self._publisher_task: asyncio.Task | None = None
+        # Usuarios cuya presencia hay que refrescar; un task los escribe en
+        # Redis cada PRESENCE_FLUSH_INTERVAL con un solo pipeline.
+        self._presence_dirty: Set[int] = set()
+        self._presence_task: asyncio.Task | None = None
+        # Desconexiones diferidas por usuario: si vuelve a conectarse antes
+        # de que venzan, se cancelan y no se escribe nada en Redis.
+        self._pending_disconnects: Dict[int, asyncio.TimerHandle] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        # Último estado de presencia por publicar de cada usuario.
+        self._pending_status: Dict[int, Dict[str, Any]] = {}
+        # Un solo task atiende el heartbeat de todas las conexiones con un
+        # heap de (deadline, conn_id).
+        self._heartbeat_heap: list[tuple[float, int]] = []
+        self._heartbeat_task: asyncio.Task | None = None
+        self._heartbeat_wakeup = asyncio.Event()
+
+    async def connect(self, user_id: int, websocket: WebSocket) -> int:
+        # Retorna el conn_id con el que se identifica la conexión.
+        conn_id = next(self._conn_counter)
+        state = ConnectionState(websocket=websocket, user_id=user_id, conn_id=conn_id)
+        self._states[conn_id] = state
+        self._user_conns.setdefault(user_id, set()).add(conn_id)
+        # Las suscripciones son por usuario: una conexión nueva recibe
+        # también los chats a los que ya se unió desde otra conexión.
+        for chat_id in self._subscriptions.setdefault(user_id, set()):
+            self._chat_members.setdefault(chat_id, {})[conn_id] = state
+        state.sender_task = self._spawn(self._run_socket_sender(state))
+        self._schedule_heartbeat(state)
+        if not self._heartbeat_task or self._heartbeat_task.done():
+            self._heartbeat_task = self._spawn(self._run_heartbeats())
         await self._ensure_listener()
-
-    async def disconnect(self, user_id: int, websocket: WebSocket | None = None) -> ConnectionState | None:
-        removed_state: ConnectionState | None = None
-        async with self._lock:
-            if websocket is None:
-                states = self._connections.pop(user_id, {})
-                self._subscriptions.pop(user_id, None)
-                for state in states.values():
-                    if state.heartbeat_task:
-                        state.heartbeat_task.cancel()
-                return None
-
-            connections = self._connections.get(user_id)
-            if not connections:
-                return None
-
-            removed_state = connections.pop(id(websocket), None)
-
-            if removed_state and removed_state.heartbeat_task:
-                removed_state.heartbeat_task.cancel()
-
-            if not connections:
-                self._connections.pop(user_id, None)
-                self._subscriptions.pop(user_id, None)
+        return conn_id
+
+    async def disconnect(self, user_id: int, conn_id: int | None = None) -> ConnectionState | None:
+        if conn_id is None:
+            conn_ids = self._user_conns.pop(user_id, None) or set()
+            chats = self._subscriptions.pop(user_id, None) or set()
+            self._verified_membership.pop(user_id, None)
+            for cid in conn_ids:
+                self._drop_state(cid, chats)
+            return None
+
+        conn_ids = self._user_conns.get(user_id)
+        if not conn_ids or conn_id not in conn_ids:
+            return None
+
+        conn_ids.discard(conn_id)
+        removed_state = self._drop_state(conn_id, self._subscriptions.get(user_id, ()))
+        if not conn_ids:
+            self._user_conns.pop(user_id, None)
+            self._subscriptions.pop(user_id, None)
+            self._verified_membership.pop(user_id, None)
         return removed_state
 
+    def _drop_state(self, conn_id: int, chat_ids) -> ConnectionState | None:
+        state = self._states.pop(conn_id, None)
+        self._remove_chat_members(chat_ids, conn_id)
+        if state and state.sender_task:
+            state.sender_task.cancel()
+        return state
+
+    def _remove_chat_members(self, chat_ids, conn_id: int) -> None:
+        # Quita una conexión del índice inverso de cada chat indicado.
+        for chat_id in chat_ids:
+            members = self._chat_members.get(chat_id)
+            if members is None:
+                continue
+            members.pop(conn_id, None)
+            if not members:
+                self._chat_members.pop(chat_id, None)
+
     async def subscribe(self, user_id: int, chat_id: int) -> None:
-        async with self._lock:
-            chats = self._subscriptions.setdefault(user_id, set())
-            chats.add(chat_id)
+        chats = self._subscriptions.setdefault(user_id, set())
+        chats.add(chat_id)
+        members = self._chat_members.setdefault(chat_id, {})
+        for conn_id in self._user_conns.get(user_id, ()):
+            members[conn_id] = self._states[conn_id]
 
     async def unsubscribe(self, user_id: int, chat_id: int) -> None:
-        async with self._lock:
-            chats = self._subscriptions.get(user_id)
-            if chats and chat_id in chats:
-                chats.remove(chat_id)
-                if not chats:
-                    self._subscriptions.pop(user_id, None)
+        chats = self._subscriptions.get(user_id)
+        if chats and chat_id in chats:
+            chats.remove(chat_id)
+            if not chats:
+                self._subscriptions.pop(user_id, None)
+            for conn_id in self._user_conns.get(user_id, ()):
+                self._remove_chat_members((chat_id,), conn_id)
+        verified = self._verified_membership.get(user_id)
+        if verified is not None:
+            verified.discard(chat_id)
+
+    def is_verified_member(self, user_id: int, chat_id: int) -> bool:
+        verified = self._verified_membership.get(user_id)
+        return verified is not None and chat_id in verified
+
+    def mark_verified_member(self, user_id: int, chat_id: int) -> None:
+        # Solo se recuerda mientras el usuario siga conectado.
+        if user_id in self._user_conns:
+            self._verified_membership[user_id].add(chat_id)
+
+    def schedule_disconnect(
+        self, user_id: int, callback: Callable[[], Awaitable[None]], delay: float
+    ) -> None:
+        self.cancel_pending_disconnect(user_id)
+
+        def _run() -> None:
+            self._pending_disconnects.pop(user_id, None)
+            self._spawn(callback())
+
+        loop = asyncio.get_running_loop()
+        self._pending_disconnects[user_id] = loop.call_later(delay, _run)
+
+    def schedule_status(self, user_id: int, presence: Dict[str, Any]) -> None:
+        # Los cambios de estado de un usuario dentro de la misma ventana se
+        # publican como un solo user.status con el estado más reciente.
+        pending = user_id in self._pending_status
+        self._pending_status[user_id] = presence
+        if pending:
+            return
+        loop = asyncio.get_running_loop()
+        loop.call_later(STATUS_DEBOUNCE_DELAY, self._flush_status, user_id)
+
+    def _flush_status(self, user_id: int) -> None:
+        presence = self._pending_status.pop(user_id, None)
+        if presence is not None:
+            self._spawn(self.publish_event(_presence_event(user_id, presence)))
+
+    def _spawn(self, coroutine: Awaitable[None]) -> asyncio.Task:
+        # Todo task en segundo plano del manager se crea aquí: se guarda una
+        # referencia hasta que termine para que el GC no lo destruya.
+        task = asyncio.ensure_future(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    def cancel_pending_disconnect(self, user_id: int) -> bool:
+        # Retorna True si había una desconexión pendiente para el usuario.
+        handle = self._pending_disconnects.pop(user_id, None)
+        if handle is None:
+            return False
+        handle.cancel()
+        return True
 
     async def has_connection(self, user_id: int) -> bool:
-        async with self._lock:
-            return bool(self._connections.get(user_id))
+        return bool(self._user_conns.get(user_id))
 
     async def publish_event(self, event: Dict[str, Any]) -> None:
-        enriched_event = dict(event)
-        enriched_event.setdefault("origin", PROCESS_ID)
-        payload = json.dumps(enriched_event, ensure_ascii=False)
-
-        redis_error: Exception | None = None
-        try:
-            await redis_async.publish(PUBSUB_CHANNEL, payload)
-        except Exception as exc:  # Redis debe ser opcional para el broadcast
-            redis_error = exc
-            logger.warning("Fallo al publicar evento en Redis: %s", exc)
-
+        # "origin" va como primera llave para que el listener reconozca sus
+        # propios eventos por prefijo, sin decodificarlos.
+        enriched_event = {"origin": PROCESS_ID, **event}
+        # El mismo texto se publica en Redis y se envía a los sockets locales.
+        payload = _encode_event(enriched_event)
+
+        # Los sockets de este proceso reciben el evento directamente, sin
+        # esperar el round-trip a Redis; Redis solo lo lleva a otros procesos.
         event_type = enriched_event.get("type")
         if event_type == "chat.message":
             chat_id = enriched_event.get("chat_id")
             if isinstance(chat_id, int):
-                await self.broadcast_event(chat_id, enriched_event)
+                await self.broadcast_event(chat_id, enriched_event, encoded=payload)
         elif event_type == "user.status":
-            await self.broadcast_all(enriched_event)
+            await self.broadcast_all(enriched_event, encoded=payload)
 
-        if redis_error:
-            logger.debug("Redis no disponible; se usó broadcast local para evento %s", event_type)
+        # La publicación en Redis se encola y la hace el publisher por lotes;
+        # quien llama no espera el round-trip.
+        await self._ensure_listener()
+        try:
+            self._publish_queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            logger.warning("Cola de publicación llena; se publica el evento %s directamente", event_type)
+            await self._publish_batch([payload])
 
-    async def broadcast_event(self, chat_id: int, event: Dict[str, Any]) -> None:
-        async with self._lock:
-            recipients: list[WebSocket] = []
-            for uid, connections in self._connections.items():
-                if chat_id in self._subscriptions.get(uid, set()):
-                    recipients.extend(state.websocket for state in connections.values())
+    async def _publish_batch(self, payloads: list[str]) -> None:
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for payload in payloads:
+                pipe.publish(PUBSUB_CHANNEL, payload)
+            await pipe.execute()
+        except Exception as exc:  # Redis debe ser opcional para el broadcast
+            logger.warning("Fallo al publicar %s eventos en Redis: %s", len(payloads), exc)
 
-        for ws in recipients:
-            with suppress(RuntimeError, WebSocketDisconnect):
-                await ws.send_json(event)
+    async def _run_publisher(self) -> None:
+        # Junta los eventos que llegan en PUBLISH_FLUSH_INTERVAL segundos
+        # (hasta PUBLISH_BATCH_SIZE) y los publica en un solo pipeline.
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._publish_queue.get()]
+            deadline = loop.time() + PUBLISH_FLUSH_INTERVAL
+            while len(batch) < PUBLISH_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._publish_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._publish_batch(batch)
+
+    async def broadcast_event(
+        self, chat_id: int, event: Dict[str, Any], *, encoded: str | None = None
+    ) -> None:
+        recipients = list(self._chat_members.get(chat_id, {}).values())
+        if not recipients:
+            return
 
-    async def broadcast_all(self, event: Dict[str, Any]) -> None:
-        async with self._lock:
-            recipients = [state.websocket for connections in self._connections.values() for state in connections.values()]
+        # El evento se serializa una sola vez para todos los destinatarios
+        # (o nunca, si ya llega serializado) y se encola en cada socket.
+        frame = _text_frame(encoded or _encode_event(event))
+        for state in recipients:
+            state.enqueue(frame)
 
-        for ws in recipients:
-            with suppress(RuntimeError, WebSocketDisconnect):
-                await ws.send_json(event)
+    async def broadcast_all(self, event: Dict[str, Any], *, encoded: str | None = None) -> None:
+        recipients = list(self._states.values())
+        if not recipients:
+            return
+
+        frame = _text_frame(encoded or _encode_event(event))
+        for state in recipients:
+            state.enqueue(frame)
+
+    async def _run_socket_sender(self, state: ConnectionState) -> None:
+        # Envía en orden los frames encolados para un socket. Si el envío
+        # falla, el socket se retira del manager.
+        while True:
+            frame = await state.send_queue.get()
+            try:
+                await state.websocket.send(frame)
+            except (RuntimeError, WebSocketDisconnect):
+                await self.disconnect(state.user_id, state.conn_id)
+                return
+            except Exception as exc:
+                logger.warning("Error al enviar evento al usuario %s: %s", state.user_id, exc)
 
     async def _ensure_listener(self) -> None:
+        if not self._writer_task or self._writer_task.done():
+            self._writer_task = self._spawn(self._run_message_writer())
+        if not self._publisher_task or self._publisher_task.done():
+            self._publisher_task = self._spawn(self._run_publisher())
+        if not self._presence_task or self._presence_task.done():
+            self._presence_task = self._spawn(self._run_presence_flusher())
         if self._listener_task and not self._listener_task.done():
             return
-        self._listener_task = asyncio.create_task(self._run_pubsub_listener())
+        self._listener_task = self._spawn(self._run_pubsub_listener())
+
+    async def submit_message(self, chat_id: int, user_id: int, content: str) -> Dict[str, Any]:
+        # Encola el mensaje y espera a que el writer lo guarde; el mensaje
+        # retornado ya tiene el message_id asignado por la base de datos.
+        await self._ensure_listener()
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        await self._write_queue.put((chat_id, user_id, content, future))
+        return await future
+
+    async def _run_message_writer(self) -> None:
+        from routers.chats import create_messages  # Lazy import to avoid circular dependency
+
+        db = Database()
+        while True:
+            batch = [await self._write_queue.get()]
+            while len(batch) < MESSAGE_WRITE_BATCH and not self._write_queue.empty():
+                batch.append(self._write_queue.get_nowait())
+            pending = [item for item in batch if not item[3].done()]
+            if not pending:
+                continue
+            try:
+                messages = await asyncio.to_thread(
+                    create_messages, db, [item[:3] for item in pending]
+                )
+            except Exception as exc:
+                for *_, future in pending:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            # Cada future recibe su propio resultado: un mensaje que falló no
+            # afecta a los demás del lote.
+            for (*_, future), message in zip(pending, messages):
+                if future.done():
+                    continue
+                if isinstance(message, Exception):
+                    future.set_exception(message)
+                else:
+                    future.set_result(message)
 
     async def _run_pubsub_listener(self) -> None:
-        pubsub = redis_async.pubsub(ignore_subscribe_messages=True)
+        pubsub = self._pubsub_redis.pubsub(ignore_subscribe_messages=True)
         await pubsub.subscribe(PUBSUB_CHANNEL)
         try:
-            async for message in pubsub.listen():
+            while True:
+                message = await pubsub.get_message(timeout=PUBSUB_POLL_TIMEOUT)
                 if not message:
                     continue
-                data = message.get("data")
-                if not data:
-                    continue
-                await self._handle_pubsub_message(data)
+                # Se drenan los mensajes que ya llegaron para despacharlos en
+                # un solo lote en lugar de una vuelta del loop por mensaje.
+                batch = [message]
+                while len(batch) < PUBSUB_BATCH_SIZE:
+                    message = await pubsub.get_message(timeout=0)
+                    if not message:
+                        break
+                    batch.append(message)
+                await self._handle_pubsub_batch(batch)
         except asyncio.CancelledError:
             raise
         finally:
             await pubsub.close()
 
-    async def _handle_pubsub_message(self, raw: Any) -> None:
+    async def _handle_pubsub_batch(self, messages: list[Dict[str, Any]]) -> None:
+        # Los eventos se despachan en el orden en que llegaron. De los
+        # user.status de un mismo usuario solo se envía el último, que es el
+        # estado vigente, y los eventos idénticos se envían una sola vez.
+        pending: Dict[tuple, tuple[Dict[str, Any], str]] = {}
+        for message in messages:
+            decoded = self._decode_pubsub_message(message.get("data"))
+            if decoded is None:
+                continue
+            event, raw = decoded
+            if event.get("type") == "user.status":
+                key = ("user.status", event.get("user_id"))
+                pending.pop(key, None)
+                pending[key] = decoded
+            else:
+                pending.setdefault(("event", raw), decoded)
+
+        for event, raw in pending.values():
+            await self._dispatch_remote_event(event, raw)
+
+    @staticmethod
+    def _decode_pubsub_message(raw: Any) -> tuple[Dict[str, Any], str] | None:
+        if not raw:
+            return None
         if isinstance(raw, bytes):
             raw = raw.decode("utf-8")
         if not isinstance(raw, str):
-            return
+            return None
+        # Eventos publicados por este mismo proceso: ya se entregaron.
+        if raw.startswith(OWN_EVENT_PREFIX):
+            return None
         try:
-            event = json.loads(raw)
-        except json.JSONDecodeError:
-            return
+            event = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            return None
+        if not isinstance(event, dict):
+            return None
 
         if event.get("origin") == PROCESS_ID:
-            return
+            return None
+        return event, raw
 
+    async def _dispatch_remote_event(self, event: Dict[str, Any], raw: str) -> None:
+        # El texto recibido de Redis se reenvía tal cual a los sockets.
         if event.get("type") == "chat.message":
             chat_id = event.get("chat_id")
             if isinstance(chat_id, int):
-                await self.broadcast_event(chat_id, event)
+                await self.broadcast_event(chat_id, event, encoded=raw)
         elif event.get("type") == "user.status":
-            await self.broadcast_all(event)
-
-    async def mark_activity(self, user_id: int, websocket: WebSocket, *, ping_id: str | None = None) -> None:
-        should_refresh_presence = False
-        async with self._lock:
-            connections = self._connections.get(user_id, {})
-            state = connections.get(id(websocket))
-            if not state:
-                return
-            if ping_id is not None:
-                expected = state.pending_ping_id
-                if expected and expected != ping_id:
-                    logger.debug(
-                        "Ping ID no coincide para el usuario %s: esperado %s, recibido %s",
-                        user_id,
-                        expected,
-                        ping_id,
-                    )
-                state.pending_ping_id = None
-            now = time.monotonic()
-            state.last_activity = now
-            if now - state.last_presence_refresh >= PRESENCE_TOUCH_INTERVAL:
-                should_refresh_presence = True
-                state.last_presence_refresh = now
+            await self.broadcast_all(event, encoded=raw)
 
-        if should_refresh_presence:
-            await _presence_touch(user_id)
+    async def mark_activity(self, conn_id: int, *, ping_id: str | None = None) -> None:
+        state = self._states.get(conn_id)
+        if not state:
+            return
+        user_id = state.user_id
+        if ping_id is not None:
+            expected = state.pending_ping_id
+            if expected and expected != ping_id:
+                logger.debug(
+                    "Ping ID no coincide para el usuario %s: esperado %s, recibido %s",
+                    user_id,
+                    expected,
+                    ping_id,
+                )
+            state.pending_ping_id = None
+        now = time.monotonic()
+        state.last_activity = now
+        if now - state.last_presence_refresh >= PRESENCE_TOUCH_INTERVAL:
+            state.last_presence_refresh = now
+            self._presence_dirty.add(user_id)
+
+    async def _run_presence_flusher(self) -> None:
+        while True:
+            await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+            if not self._presence_dirty:
+                continue
+            dirty, self._presence_dirty = self._presence_dirty, set()
+            # Quien se desconectó mientras tanto ya no se refresca.
+            user_ids = {user_id for user_id in dirty if user_id in self._user_conns}
+            if user_ids:
+                await _presence_touch_many(user_ids)
+
+    def _schedule_heartbeat(self, state: ConnectionState) -> None:
+        state.heartbeat_deadline = time.monotonic() + HEARTBEAT_INTERVAL
+        heapq.heappush(self._heartbeat_heap, (state.heartbeat_deadline, state.conn_id))
+        self._heartbeat_wakeup.set()
+
+    async def _run_heartbeats(self) -> None:
+        # Todos los deadlines se calculan como ahora + HEARTBEAT_INTERVAL, así
+        # que una entrada nueva nunca queda antes que la cima del heap y basta
+        # con dormir hasta el primer deadline.
+        heap = self._heartbeat_heap
+        while True:
+            if not heap:
+                self._heartbeat_wakeup.clear()
+                await self._heartbeat_wakeup.wait()
+                continue
+            delay = heap[0][0] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
 
-    async def _heartbeat_loop(self, user_id: int, connection_key: int) -> None:
-        try:
-            while True:
-                await asyncio.sleep(HEARTBEAT_INTERVAL)
-                async with self._lock:
-                    connections = self._connections.get(user_id)
-                    if not connections:
-                        return
-                    state = connections.get(connection_key)
-                    if not state:
-                        return
-                    websocket = state.websocket
-                    last_activity = state.last_activity
-                now = time.monotonic()
-                if now - last_activity > IDLE_TIMEOUT:
+            now = time.monotonic()
+            while heap and heap[0][0] <= now:
+                deadline, conn_id = heapq.heappop(heap)
+                state = self._states.get(conn_id)
+                # Conexión cerrada o entrada reemplazada: se descarta.
+                if state is None or state.heartbeat_deadline != deadline:
+                    continue
+                if now - state.last_activity > IDLE_TIMEOUT:
                     state.disconnect_status = "inactive"
-                    with suppress(RuntimeError, WebSocketDisconnect):
-                        await websocket.close(code=4408)
-                    return
-
+                    self._spawn(self._close_idle(state.websocket))
+                    continue
                 ping_id = uuid.uuid4().hex
-                async with self._lock:
-                    connections = self._connections.get(user_id)
-                    if not connections:
-                        return
-                    state = connections.get(connection_key)
-                    if not state:
-                        return
-                    state.pending_ping_id = ping_id
-                with suppress(RuntimeError, WebSocketDisconnect):
-                    await websocket.send_json(
-                        {
-                            "type": "system.ping",
-                            "ping_id": ping_id,
-                            "server_timestamp": _utcnow_iso(),
-                        }
-                    )
-        except asyncio.CancelledError:
-            raise
+                state.pending_ping_id = ping_id
+                self._spawn(self._send_ping(state.websocket, ping_id))
+                self._schedule_heartbeat(state)
+
+    @staticmethod
+    async def _close_idle(websocket: WebSocket) -> None:
+        with suppress(RuntimeError, WebSocketDisconnect):
+            await websocket.close(code=4408)
+
+    @staticmethod
+    async def _send_ping(websocket: WebSocket, ping_id: str) -> None:
+        with suppress(RuntimeError, WebSocketDisconnect):
+            await _send_event(
+                websocket,
+                {
+                    "type": "system.ping",
+                    "ping_id": ping_id,
+                    "server_timestamp": _utcnow_iso(),
+                }
+            )
 
 
 manager = ConnectionManager()
 
 
 async def _user_is_member(chat_id: int, user_id: int) -> bool:
-    db = Database()
-    rows = db.fetch_query(
-        """
-        SELECT 1
-        FROM chat_members
-        WHERE chat_id = ? AND user_id = ?
-        LIMIT 1
-        """,
-        (chat_id, user_id),
-    )
-    return bool(rows)
+    # Usa la misma verificación que las rutas REST: una sola consulta EXISTS
+    # (cubierta por la llave primaria de chat_members y guardada en la caché
+    # de sentencias de la conexión del hilo) con su caché de membresías. La
+    # consulta a SQLite se hace en un hilo para no bloquear el event loop.
+    from routers.chats import _user_is_member as chat_member_check  # Lazy import to avoid circular dependency
 
+    return await asyncio.to_thread(chat_member_check, Database(), chat_id, user_id)
 
-async def _handle_join_chat(user_id: int, chat_id: int, websocket: WebSocket) -> None:
+
+async def _ensure_member(user_id: int, chat_id: int) -> bool:
+    # Consulta la base solo si la membresía no se validó antes en esta
+    # conexión (al unirse al chat o en un mensaje anterior).
+    if manager.is_verified_member(user_id, chat_id):
+        return True
     if not await _user_is_member(chat_id, user_id):
-        await websocket.send_json(
+        return False
+    manager.mark_verified_member(user_id, chat_id)
+    return True
+
+
+async def _payload_chat_id(user_id: int, payload: Dict[str, Any], websocket: WebSocket, conn_id: int) -> int | None:
+    # Acciones de chat: registran actividad y validan chat_id.
+    await manager.mark_activity(conn_id)
+    chat_id = payload.get("chat_id")
+    if not isinstance(chat_id, int):
+        await _send_event(websocket, {"type": "chat.error", "error": "chat_id inválido."})
+        return None
+    return chat_id
+
+
+async def _handle_pong(user_id: int, payload: Dict[str, Any], websocket: WebSocket, conn_id: int) -> None:
+    await manager.mark_activity(conn_id, ping_id=payload.get("ping_id"))
+    await _send_event(
+        websocket,
+        {
+            "type": "system.pong",
+            "ping_id": payload.get("ping_id"),
+            "server_timestamp": _utcnow_iso(),
+            "connection_ttl": CONNECTION_TTL_SECONDS,
+        }
+    )
+
+
+async def _handle_ping(user_id: int, payload: Dict[str, Any], websocket: WebSocket, conn_id: int) -> None:
+    await manager.mark_activity(conn_id)
+    await _send_event(
+        websocket,
+        {
+            "type": "system.pong",
+            "ping_id": payload.get("ping_id") or uuid.uuid4().hex,
+            "server_timestamp": _utcnow_iso(),
+            "connection_ttl": CONNECTION_TTL_SECONDS,
+        }
+    )
+
+
+async def _handle_join_chat(user_id: int, payload: Dict[str, Any], websocket: WebSocket, conn_id: int) -> None:
+    chat_id = await _payload_chat_id(user_id, payload, websocket, conn_id)
+    if chat_id is None:
+        return
+    if not await _ensure_member(user_id, chat_id):
+        await _send_event(
+            websocket,
             {
                 "type": "chat.error",
                 "chat_id": chat_id,
@@ -398,48 +845,78 @@ async def _handle_join_chat(user_id: int, chat_id: int, websocket: WebSocket) ->
         )
         return
     await manager.subscribe(user_id, chat_id)
-    await websocket.send_json({"type": "chat.joined", "chat_id": chat_id})
+    await _send_event(websocket, {"type": "chat.joined", "chat_id": chat_id})
 
 
-async def _handle_leave_chat(user_id: int, chat_id: int, websocket: WebSocket) -> None:
+async def _handle_leave_chat(user_id: int, payload: Dict[str, Any], websocket: WebSocket, conn_id: int) -> None:
+    chat_id = await _payload_chat_id(user_id, payload, websocket, conn_id)
+    if chat_id is None:
+        return
     await manager.unsubscribe(user_id, chat_id)
-    await websocket.send_json({"type": "chat.left", "chat_id": chat_id})
+    await _send_event(websocket, {"type": "chat.left", "chat_id": chat_id})
 
 
-async def _handle_send_message(
-    user_id: int,
-    chat_id: int,
-    content: str,
-    websocket: WebSocket,
-) -> None:
-    if not await _user_is_member(chat_id, user_id):
-        await websocket.send_json(
+async def _handle_send_message(user_id: int, payload: Dict[str, Any], websocket: WebSocket, conn_id: int) -> None:
+    chat_id = await _payload_chat_id(user_id, payload, websocket, conn_id)
+    if chat_id is None:
+        return
+    # El contenido se valida antes de consultar la membresía.
+    content = payload.get("content", "")
+    clean_content = content.strip() if isinstance(content, str) else ""
+    if not clean_content:
+        await _send_event(
+            websocket,
             {
                 "type": "chat.error",
                 "chat_id": chat_id,
-                "error": "No tienes permiso para enviar mensajes en este chat.",
+                "error": "El mensaje no puede estar vacío.",
             }
         )
         return
 
-    clean_content = content.strip()
-    if not clean_content:
-        await websocket.send_json(
+    if not await _ensure_member(user_id, chat_id):
+        await _send_event(
+            websocket,
             {
                 "type": "chat.error",
                 "chat_id": chat_id,
-                "error": "El mensaje no puede estar vacío.",
+                "error": "No tienes permiso para enviar mensajes en este chat.",
             }
         )
         return
 
-    db = Database()
-    from routers.chats import create_message  # Lazy import to avoid circular dependency
-
-    message = create_message(db, chat_id, user_id, clean_content)
+    try:
+        message = await manager.submit_message(chat_id, user_id, clean_content)
+    except Exception:
+        logger.exception("No se pudo guardar el mensaje del usuario %s en el chat %s", user_id, chat_id)
+        await _send_event(
+            websocket,
+            {
+                "type": "chat.error",
+                "chat_id": chat_id,
+                "error": "No se pudo guardar el mensaje.",
+            }
+        )
+        return
     event = _build_chat_message_event(message)
     await manager.publish_event(event)
-    await websocket.send_json({"type": "chat.sent", "chat_id": chat_id, "message_id": message["message_id"]})
+    await _send_event(websocket, {"type": "chat.sent", "chat_id": chat_id, "message_id": message["message_id"]})
+
+
+# Tabla de acciones del WebSocket: nombre (en minúsculas) -> handler.
+WEBSOCKET_ACTIONS = {
+    "system.pong": _handle_pong,
+    "pong": _handle_pong,
+    "ping": _handle_ping,
+    "heartbeat": _handle_ping,
+    "system.ping": _handle_ping,
+    "join": _handle_join_chat,
+    "join_chat": _handle_join_chat,
+    "leave": _handle_leave_chat,
+    "leave_chat": _handle_leave_chat,
+    "send": _handle_send_message,
+    "send_message": _handle_send_message,
+}
 
 
 def _build_chat_message_event(message: Dict[str, Any]) -> Dict[str, Any]:
@@ -461,7 +938,6 @@ async def create_or_confirm_connection(user: User = Depends(current_user)):
         user_id = user.user_id
         key = _membership_key(user_id)
 
-        is_new = not redis_sync.exists(key)
         connection_info = {
             "status": "connecting",
             "username": user.username,
@@ -469,11 +945,15 @@ async def create_or_confirm_connection(user: User = Depends(current_user)):
             "email": user.email or "",
             "last_seen": _utcnow_iso(),
         }
-        pipe = redis_sync.pipeline()
+        # EXISTS va dentro del mismo MULTI/EXEC que las escrituras: se sabe
+        # si la conexión ya existía con un solo round-trip a Redis.
+        pipe = redis_async.pipeline()
+        pipe.exists(key)
         pipe.hset(key, mapping=connection_info)
         pipe.hsetnx(key, "connection_count", 0)
-        pipe.expire(key, CONNECTION_TTL_SECONDS)
-        pipe.execute()
+        _queue_presence_expiry(pipe, user_id)
+        results = await pipe.execute()
+        is_new = not results[0]
         message = "Connection created" if is_new else "Connection refreshed"
 
         has_websocket = await manager.has_connection(user_id)
@@ -500,25 +980,26 @@ async def websocket_connection(websocket: WebSocket, token: str | None = None):
     if not token:
         raise WebSocketException(code=4401, reason="Token requerido.")
 
+    # Los clientes que se reconectan con el mismo token se validan desde la
+    # caché de auth; los demás se decodifican fuera del event loop.
     try:
-        payload = jwt.decode(token, SECRET, algorithms=[ALGORITHM])
-        user_id_str = payload.get("sub")
-        if user_id_str is None:
-            raise WebSocketException(code=4401, reason="Token inválido.")
-        user_id = int(user_id_str)
+        user = await authenticate_token(token)
     except (JWTError, ValueError, TypeError):
         raise WebSocketException(code=4401, reason="Token inválido.")
-
-    user = search_user(user_id)
     if not user:
         raise WebSocketException(code=4401, reason="Usuario no encontrado.")
+    user_id = user.user_id
 
     await websocket.accept()
-    await manager.connect(user_id, websocket)
+    conn_id = await manager.connect(user_id, websocket)
 
-    presence = await _presence_increment(user)
-    if presence.get("status"):
-        await manager.publish_event(_presence_event(user_id, presence))
+    # Si el usuario se reconecta antes de que se aplique su desconexión, la
+    # conexión anterior (que sigue contada en Redis) pasa a esta: no hay
+    # escrituras de presencia ni eventos de estado.
+    if not manager.cancel_pending_disconnect(user_id):
+        presence = await _presence_increment(user)
+        if presence.get("status"):
+            manager.schedule_status(user_id, presence)
 
     try:
         while True:
@@ -540,59 +1021,24 @@ async def websocket_connection(websocket: WebSocket, token: str | None = None):
                 )
                 break
             try:
-                payload = json.loads(message)
-            except json.JSONDecodeError:
-                await websocket.send_json({"type": "chat.error", "error": "Formato inválido."})
+                payload = orjson.loads(message)
+            except orjson.JSONDecodeError:
+                payload = None
+            if not isinstance(payload, dict):
+                await _send_event(websocket, {"type": "chat.error", "error": "Formato inválido."})
                 continue
             action_value = payload.get("type") or payload.get("action")
             if not action_value or not isinstance(action_value, str):
-                await websocket.send_json({"type": "chat.error", "error": "Acción no especificada."})
+                await _send_event(websocket, {"type": "chat.error", "error": "Acción no especificada."})
                 continue
             action = action_value.lower()
 
-            if action in {"system.pong", "pong"}:
-                await manager.mark_activity(user_id, websocket, ping_id=payload.get("ping_id"))
-                await websocket.send_json(
-                    {
-                        "type": "system.pong",
-                        "ping_id": payload.get("ping_id"),
-                        "server_timestamp": _utcnow_iso(),
-                        "connection_ttl": CONNECTION_TTL_SECONDS,
-                    }
-                )
-                continue
-
-            if action in {"ping", "heartbeat", "system.ping"}:
-                await manager.mark_activity(user_id, websocket)
-                await websocket.send_json(
-                    {
-                        "type": "system.pong",
-                        "ping_id": payload.get("ping_id") or uuid.uuid4().hex,
-                        "server_timestamp": _utcnow_iso(),
-                        "connection_ttl": CONNECTION_TTL_SECONDS,
-                    }
-                )
+            handler = WEBSOCKET_ACTIONS.get(action)
+            if handler is None:
+                await manager.mark_activity(conn_id)
+                await _send_event(websocket, {"type": "chat.error", "error": f"Acción desconocida: {action}"})
                 continue
-            await manager.mark_activity(user_id, websocket)
-
-            chat_id = payload.get("chat_id")
-            if action in {"join", "join_chat"}:
-                if isinstance(chat_id, int):
-                    await _handle_join_chat(user_id, chat_id, websocket)
-                else:
-                    await websocket.send_json({"type": "chat.error", "error": "chat_id inválido."})
-            elif action in {"leave", "leave_chat"}:
-                if isinstance(chat_id, int):
-                    await _handle_leave_chat(user_id, chat_id, websocket)
-                else:
-                    await websocket.send_json({"type": "chat.error", "error": "chat_id inválido."})
-            elif action in {"send", "send_message"}:
-                if not isinstance(chat_id, int):
-                    await websocket.send_json({"type": "chat.error", "error": "chat_id inválido."})
-                    continue
-                await _handle_send_message(user_id, chat_id, payload.get("content", ""), websocket)
-            else:
-                await websocket.send_json({"type": "chat.error", "error": f"Acción desconocida: {action}"})
+            await handler(user_id, payload, websocket, conn_id)
     except WebSocketDisconnect as exc:
         logger.info(
             "Cliente WebSocket %s desconectado: code=%s reason=%r",
@@ -602,11 +1048,21 @@ async def websocket_connection(websocket: WebSocket, token: str | None = None):
         )
     finally:
         if user_id is not None:
-            state = await manager.disconnect(user_id, websocket)
+            state = await manager.disconnect(user_id, conn_id)
             disconnect_status = state.disconnect_status if state else "disconnected"
-            presence = await _presence_decrement(user_id, fallback_status=disconnect_status)
-            if presence.get("status"):
-                await manager.publish_event(_presence_event(user_id, presence))
+            finish = partial(_finish_disconnect, user_id, disconnect_status)
+            if PRESENCE_DISCONNECT_DELAY > 0 and not await manager.has_connection(user_id):
+                # Último socket del usuario: la desconexión se aplica con
+                # retraso para absorber las reconexiones inmediatas.
+                manager.schedule_disconnect(user_id, finish, PRESENCE_DISCONNECT_DELAY)
+            else:
+                await finish()
+
+
+async def _finish_disconnect(user_id: int, disconnect_status: str) -> None:
+    presence = await _presence_decrement(user_id, fallback_status=disconnect_status)
+    if presence.get("status"):
+        manager.schedule_status(user_id, presence)
 
 
 async def notify_new_message(message: Dict[str, Any]) -> None:
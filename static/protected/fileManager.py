@@ -10,18 +10,52 @@ Bodyguard for all protected files
 from dataclasses import dataclass
 from pathlib import Path
 import mimetypes
+import os
+import posixpath
 import shutil
 import io
-import re
-from typing import Iterable
-from uuid import uuid4
-from contextlib import contextmanager
-
+import string
+from typing import BinaryIO
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from functools import lru_cache
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+import hashlib
+from importlib import metadata
+import logging
+
+import asyncio
+
+import aiofiles.tempfile
 from PIL import Image, ImageOps
 
 # Import modules
 
 # Global variables and functions
+logger = logging.getLogger(__name__)
+
+# Tabla para str.translate: todo carácter ASCII fuera de [A-Za-z0-9_-] pasa a
+# "_". Los no ASCII se convierten antes en "?" (uno por carácter), así que
+# también terminan como "_".
+_SANITIZE_ALLOWED = frozenset(string.ascii_letters + string.digits + "_-")
+_SANITIZE_TABLE = str.maketrans(
+    {chr(code): "_" for code in range(128) if chr(code) not in _SANITIZE_ALLOWED}
+)
+
+
+def sanitizeName(name: str) -> str:
+    return name.encode("ascii", "replace").decode("ascii").translate(_SANITIZE_TABLE)
+
+
+@lru_cache(maxsize=256)
+def guessMimeType(extension: str) -> str:
+    # El tipo MIME solo depende de la extensión: se calcula una vez por cada una.
+    guessed, _ = mimetypes.guess_type(f"file{extension}")
+    return (guessed or "application/octet-stream").lower()
+
+
 @dataclass
 class ProfileImageInfo:
     user_id: int
@@ -52,16 +86,183 @@ class Collection:
     # Ejemplo: ImagenesPerfil
     name: str
 
+# Ruta de este módulo y su carpeta, resueltas una sola vez al importar.
+_MODULE_PATH = str(Path(__file__).resolve())
+_MODULE_DIR = os.path.dirname(_MODULE_PATH)
+
 def getFolders(root: str | Path | None = None) -> list[str]:
     # Retorna los nombres de los folders que se encuentran en la carpeta indicada
-    base_path = Path(root) if root else Path(__file__).resolve().parent
-    if not base_path.exists():
+    base_path = root or _MODULE_DIR
+    try:
+        # scandir trae el tipo de cada entrada junto con el nombre: no hace
+        # falta un stat por entrada para saber si es folder.
+        with os.scandir(base_path) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+    except FileNotFoundError:
         return []
-    return sorted([item.name for item in base_path.iterdir() if item.is_dir()])
+
+def isFolderEmpty(path: str | Path) -> bool:
+    # Basta con leer la primera entrada del folder.
+    with os.scandir(path) as entries:
+        return next(entries, None) is None
 
 def getPath(include_filename: bool = True) -> str:
-    path = Path(__file__).resolve()
-    return str(path if include_filename else path.parent)
+    return _MODULE_PATH if include_filename else _MODULE_DIR
+
+def getCacheValidators(path: str | Path, stat_result: os.stat_result | None = None) -> dict[str, str]:
+    # Retorna los encabezados ETag y Last-Modified del archivo. El ETag
+    # cambia si cambia la ruta, el tamaño o la fecha de modificación.
+    if stat_result is None:
+        stat_result = os.stat(path)
+    digest = hashlib.blake2b(
+        f"{path}:{stat_result.st_mtime_ns}:{stat_result.st_size}".encode("utf-8"),
+        digest_size=16,
+    ).hexdigest()
+    return {
+        "etag": f'"{digest}"',
+        "last_modified": formatdate(stat_result.st_mtime, usegmt=True),
+    }
+
+def isNotModified(request_headers, etag: str, last_modified: str) -> bool:
+    # Evalúa If-None-Match (tiene prioridad) o If-Modified-Since contra los
+    # validadores del archivo; True significa que se puede responder 304.
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match:
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in candidates or etag in candidates
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+# Si se define, las descargas se delegan a Nginx con X-Accel-Redirect: el
+# servidor solo valida permisos y Nginx envía el archivo con sendfile().
+# Ejemplo de configuración (prefijo "/_protected/"):
+#   location /_protected/ { internal; alias /ruta/a/static/protected/; }
+ACCEL_REDIRECT_PREFIX = os.getenv("PROTECTED_ACCEL_REDIRECT_PREFIX", "")
+
+def getAccelRedirect(relative_path: str) -> str | None:
+    # Retorna la URI interna de Nginx para una ruta relativa a la carpeta
+    # protegida, o None si X-Accel-Redirect no está configurado.
+    if not ACCEL_REDIRECT_PREFIX:
+        return None
+    return ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(Path(relative_path).as_posix().lstrip("/"))
+
+def getContentDisposition(filename: str) -> str:
+    # Mismo formato que usa FileResponse para el nombre de descarga.
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Intentos para encontrar un nombre libre al guardar un adjunto.
+RESERVE_ATTEMPTS = 5
+# Tamaño de bloque al copiar a disco un objeto tipo archivo.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Factor de reducción previa (BOX) antes del LANCZOS final al redimensionar.
+RESIZE_REDUCING_GAP = 3.0
+# Opciones del codificador por formato: priorizan la velocidad de guardado.
+IMAGE_SAVE_OPTIONS: dict[str, dict] = {
+    "JPEG": {"quality": 85, "optimize": False, "progressive": False},
+    "PNG": {"compress_level": 1},
+}
+def isPillowSimd() -> bool:
+    # Pillow-SIMD reemplaza al paquete Pillow con la misma API y acelera con
+    # SSE4/AVX2 el resize y convert que usa _process_image.
+    try:
+        metadata.distribution("pillow-simd")
+    except metadata.PackageNotFoundError:
+        return False
+    return True
+
+PILLOW_SIMD = isPillowSimd()
+if not PILLOW_SIMD:
+    logger.info(
+        "Pillow-SIMD no está instalado; en hosts x86-64 acelera el redimensionado "
+        "de imágenes de perfil (pip install pillow-simd en lugar de pillow)."
+    )
+
+# Hilos propios para decodificar y redimensionar imágenes (Pillow libera el
+# GIL en esas operaciones); así no ocupan el executor por defecto del loop.
+IMAGE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="image")
+
+# Extensiones permitidas para los adjuntos de chat y los tipos MIME
+# aceptados para cada una; se arma una sola vez al importar el módulo.
+ATTACHMENT_MIME_TYPES: dict[str, frozenset[str]] = {
+    extension: frozenset(types | {"application/octet-stream"})
+    for extension, types in {
+        ".jpg": {"image/jpeg"},
+        ".jpeg": {"image/jpeg"},
+        ".png": {"image/png"},
+        ".zip": {"application/zip"},
+        ".doc": {"application/msword"},
+        ".docx": {"application/vnd.openxmlformats-officedocument.wordprocessingml.document"},
+        ".ppt": {"application/vnd.ms-powerpoint"},
+        ".pptx": {"application/vnd.openxmlformats-officedocument.presentationml.presentation"},
+        ".xls": {"application/vnd.ms-excel"},
+        ".xlsx": {"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"},
+        ".md": {"text/markdown", "text/plain"},
+    }.items()
+}
+
+async def spoolUpload(upload, directory: str | Path, max_bytes: int) -> tuple[str, int]:
+    # Copia por bloques un archivo subido (cualquier objeto con `await
+    # read(n)`, p. ej. UploadFile) a un temporal dentro de `directory`, sin
+    # cargarlo completo en memoria. Retorna (ruta del temporal, bytes leídos);
+    # si se supera max_bytes la copia se detiene y los bytes leídos son
+    # mayores que max_bytes. Quien llama debe borrar el temporal.
+    async with aiofiles.tempfile.NamedTemporaryFile("wb", delete=False, dir=directory) as temp_file:
+        total_bytes = 0
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            total_bytes += len(chunk)
+            if total_bytes > max_bytes:
+                break
+            await temp_file.write(chunk)
+    return temp_file.name, total_bytes
+
+# _coerce_target solo resuelve (realpath) las carpetas; el último componente
+# se normaliza como texto. Para que un enlace simbólico en esa posición no
+# saque la escritura de root, los archivos se abren con O_NOFOLLOW.
+O_NOFOLLOW = getattr(os, "O_NOFOLLOW", 0)
+
+def openNoFollow(path: str | Path, flags: int) -> int:
+    # opener para open(): igual que el de la biblioteca estándar, pero sin
+    # seguir un enlace simbólico en el último componente.
+    return os.open(path, flags | O_NOFOLLOW, 0o666)
+
+def writeFileAtomic(destination: str | Path, data: bytes) -> None:
+    # Escribe `data` en un temporal junto a `destination` y lo renombra al
+    # final, así nunca se sirve un archivo a medio escribir. El espacio se
+    # reserva de una vez (fallocate), el contenido se escribe con un solo
+    # pwrite y después se le indica al kernel que no conserve esas páginas
+    # en caché: la imagen recién subida no se vuelve a leer de inmediato.
+    destination = Path(destination)
+    temp_path = destination.with_name(f".{destination.name}.tmp")
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_NOFOLLOW, 0o644)
+    try:
+        if data and hasattr(os, "posix_fallocate"):
+            with suppress(OSError):
+                os.posix_fallocate(fd, 0, len(data))
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += os.pwrite(fd, view[written:], written)
+        if hasattr(os, "posix_fadvise"):
+            with suppress(OSError):
+                os.posix_fadvise(fd, 0, len(data), os.POSIX_FADV_DONTNEED)
+    except BaseException:
+        os.close(fd)
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    os.close(fd)
+    os.replace(temp_path, destination)
 
 # Datasets
 paths: dict = {
@@ -76,36 +277,83 @@ paths: dict = {
 class FileManager:
 
     def __init__(self) -> None:
-        self.root: Path = Path(getPath(include_filename=False)).resolve()
+        # getPath ya retorna una ruta resuelta.
+        self.root: Path = Path(getPath(include_filename=False))
         self.root.mkdir(parents=True, exist_ok=True)
-        self._refresh_paths()
+        self._root_str = str(self.root)
+        self.upload_collection: Path = Path(".uploads")
+        # mtime de root con el que se listaron las colecciones por última vez.
+        self._collections_mtime: int | None = None
+        # Carpetas ya resueltas con realpath y validadas: ruta relativa
+        # normalizada -> ruta absoluta real.
+        self._resolved_dirs: dict[str, str] = {}
+        paths["root"] = self._root_str
+
+    def _refresh_paths(self, force: bool = False) -> None:
+        # Solo se vuelve a listar root si cambió su mtime (crear o borrar una
+        # colección lo actualiza); si no, basta con un stat.
+        mtime = os.stat(self._root_str).st_mtime_ns
+        if force or mtime != self._collections_mtime:
+            paths["collections"] = getFolders(self._root_str)
+            self._collections_mtime = mtime
+
+    def _inside_root(self, resolved: str) -> str:
+        if resolved != self._root_str and not resolved.startswith(self._root_str + os.sep):
+            raise ValueError("The target path must live inside the protected root.")
+        return resolved
 
-    def _refresh_paths(self) -> None:
-        paths["root"] = str(self.root)
-        paths["collections"] = getFolders(self.root)
+    def _resolve_dir(self, relative_dir: str) -> str:
+        # realpath (un lstat por componente) se paga una sola vez por
+        # carpeta; solo se guardan las que ya existen, así una carpeta que
+        # todavía no se crea se vuelve a resolver en la siguiente llamada.
+        cached = self._resolved_dirs.get(relative_dir)
+        if cached is not None:
+            return cached
+        resolved = self._inside_root(os.path.realpath(os.path.join(self._root_str, relative_dir)))
+        if os.path.isdir(resolved):
+            self._resolved_dirs[relative_dir] = resolved
+        return resolved
+
+    def _forget_resolved_dirs(self, relative_dir: str) -> None:
+        # Se llama al borrar una carpeta: se olvidan ella y sus subcarpetas.
+        prefix = relative_dir + os.sep
+        for key in list(self._resolved_dirs):
+            if key == relative_dir or key.startswith(prefix):
+                self._resolved_dirs.pop(key, None)
 
     def _coerce_target(self, target: "Collection | str | Path") -> Path:
+        # Retorna una ruta absoluta y normalizada dentro de root; quien la
+        # recibe no necesita volver a llamar a resolve().
         if isinstance(target, Collection):
             if not target.name:
                 raise ValueError("Collection name cannot be empty.")
             target = target.name
-        candidate = Path(target)
-        if candidate.is_absolute():
-            resolved = candidate.resolve(strict=False)
-        else:
-            resolved = (self.root / candidate).resolve(strict=False)
-        try:
-            resolved.relative_to(self.root)
-        except ValueError as exc:
-            raise ValueError("The target path must live inside the protected root.") from exc
-        return resolved
+        # Camino rápido: en una ruta relativa sin ".." la carpeta padre se
+        # resuelve con realpath una vez y queda en caché; el último
+        # componente solo se normaliza (los archivos se abren con
+        # O_NOFOLLOW, ver openNoFollow).
+        text = os.fspath(target)
+        if text and not os.path.isabs(text) and ".." not in text.replace("\\", "/").split("/"):
+            parent, leaf = os.path.split(os.path.normpath(text))
+            if leaf and leaf != ".":
+                return Path(os.path.join(self._resolve_dir(parent), leaf))
+        if not os.path.isabs(text):
+            text = os.path.join(self._root_str, text)
+        return Path(self._inside_root(os.path.realpath(text)))
+
+    def upload_folder(self) -> Path:
+        # Carpeta para las subidas en curso. Vive dentro de la raíz protegida
+        # (mismo sistema de archivos), así que mover el archivo terminado a
+        # su colección es un simple rename, sin copiar los bytes.
+        folder = self._coerce_target(self.upload_collection)
+        folder.mkdir(parents=True, exist_ok=True)
+        return folder
 
     """INTERNAL API"""
 
     def getAllCollections(self, refresh: bool = False) -> list[str]:
         # Para consultar todas las colecciones
-        if refresh:
-            self._refresh_paths()
+        self._refresh_paths(force=refresh)
         return list(paths.get("collections", []))
 
     def createFolder(self, target: "Collection | str | Path", *, exist_ok: bool = False) -> str:
@@ -117,7 +365,6 @@ class FileManager:
                 raise FileExistsError(f"The folder {destination.name} already exists.")
         else:
             destination.mkdir(parents=True)
-        self._refresh_paths()
         return str(destination)
 
     def deleteFolder(
@@ -134,7 +381,7 @@ class FileManager:
             raise FileNotFoundError(f"The folder {destination} does not exist.")
         if not destination.is_dir():
             raise NotADirectoryError(f"{destination} is not a folder.")
-        if any(destination.iterdir()):
+        if not isFolderEmpty(destination):
             if not recursive:
                 raise OSError(
                     f"The folder {destination} is not empty. Use recursive=True to remove it and its contents."
@@ -142,34 +389,61 @@ class FileManager:
             shutil.rmtree(destination)
         else:
             destination.rmdir()
-        self._refresh_paths()
+        self._forget_resolved_dirs(os.path.relpath(destination, self._root_str))
         return True
 
     def createFile(
         self,
         name: "Collection | str | Path",
-        data: bytes | bytearray | memoryview | str | None = None,
+        data: bytes | bytearray | memoryview | str | BinaryIO | None = None,
         *,
         overwrite: bool = False,
     ) -> str:
         destination = self._coerce_target(name)
-        if destination.exists():
+        # Sin overwrite el archivo se abre con O_EXCL ("x"): la creación falla
+        # de forma atómica si ya existe, sin un exists() previo.
+        # Sin datos y con overwrite se abre en "a" para no truncar, como touch.
+        is_text = not (
+            data is None or isinstance(data, (bytes, bytearray, memoryview)) or hasattr(data, "read")
+        )
+        if not overwrite:
+            mode = "x"
+        elif data is None:
+            mode = "a"
+        else:
+            mode = "w"
+        mode += "" if is_text else "b"
+        try:
+            buffer = self._open_for_create(destination, mode)
+        except FileExistsError:
             if destination.is_dir():
                 raise IsADirectoryError(f"{destination} is a directory; cannot overwrite with a file.")
-            if not overwrite:
-                raise FileExistsError(f"The file {destination} already exists.")
-        else:
-            destination.parent.mkdir(parents=True, exist_ok=True)
-        if data is None:
-            destination.touch(exist_ok=overwrite)
-        elif isinstance(data, (bytes, bytearray, memoryview)):
-            with destination.open("wb") as buffer:
-                buffer.write(bytes(data))
-        else:
-            with destination.open("w", encoding="utf-8") as buffer:
+            raise FileExistsError(f"The file {destination} already exists.")
+        except IsADirectoryError:
+            raise IsADirectoryError(f"{destination} is a directory; cannot overwrite with a file.")
+        with buffer:
+            if data is None:
+                pass
+            elif is_text:
                 buffer.write(str(data))
+            elif hasattr(data, "read"):
+                # Los objetos tipo archivo se copian por bloques, sin cargarlos
+                # completos en memoria.
+                shutil.copyfileobj(data, buffer, COPY_CHUNK_SIZE)
+            else:
+                buffer.write(data)
         return str(destination)
 
+    @staticmethod
+    def _open_for_create(destination: Path, mode: str):
+        # La carpeta padre solo se crea si el primer intento indica que falta.
+        encoding = None if "b" in mode else "utf-8"
+        try:
+            return open(destination, mode, encoding=encoding, opener=openNoFollow)
+        except FileNotFoundError:
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            return open(destination, mode, encoding=encoding, opener=openNoFollow)
+
     def deleteFile(self, name: "Collection | str | Path", *, missing_ok: bool = False) -> bool:
         destination = self._coerce_target(name)
         if not destination.exists():
@@ -194,81 +468,91 @@ class ChatAttachmentManager(FileManager):
     def __init__(self) -> None:
         super().__init__()
         self.collection: Path = Path("chats_files")
-        self.allowed_extensions: dict[str, set[str]] = self._build_allowed_mime_map()
-
-    @staticmethod
-    def _build_allowed_mime_map() -> dict[str, set[str]]:
-        fallback = {"application/octet-stream"}
-        mapping: dict[str, Iterable[str]] = {
-            ".jpg": {"image/jpeg"},
-            ".jpeg": {"image/jpeg"},
-            ".png": {"image/png"},
-            ".zip": {"application/zip"},
-            ".doc": {"application/msword"},
-            ".docx": {"application/vnd.openxmlformats-officedocument.wordprocessingml.document"},
-            ".ppt": {"application/vnd.ms-powerpoint"},
-            ".pptx": {"application/vnd.openxmlformats-officedocument.presentationml.presentation"},
-            ".xls": {"application/vnd.ms-excel"},
-            ".xlsx": {"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"},
-            ".md": {"text/markdown", "text/plain"},
-        }
-        return {ext: set(types) | fallback for ext, types in mapping.items()}
-
-    def _ensure_chat_folder(self, chat_id: int) -> Path:
-        collection_path = self.collection / f"chat_{chat_id}"
-        folder = self._coerce_target(collection_path)
-        folder.mkdir(parents=True, exist_ok=True)
+        self._collection_str = self.collection.as_posix()
+        self.upload_collection: Path = self.collection / ".uploads"
+        self.allowed_extensions: dict[str, frozenset[str]] = ATTACHMENT_MIME_TYPES
+        # Carpetas de chat ya creadas: chat_id -> ruta absoluta.
+        self._chat_folder_cache: dict[int, str] = {}
+
+    def _ensure_chat_folder(self, chat_id: int) -> str:
+        # Los adjuntos siguientes del mismo chat no repiten _coerce_target
+        # ni el mkdir.
+        cached = self._chat_folder_cache.get(chat_id)
+        if cached is not None:
+            return cached
+        relative_folder = posixpath.join(self._collection_str, f"chat_{chat_id}")
+        self._coerce_target(relative_folder).mkdir(parents=True, exist_ok=True)
+        # Ya creada, la carpeta se resuelve completa: los adjuntos se arman
+        # como texto a partir de ella.
+        folder = self._resolve_dir(os.path.normpath(relative_folder))
+        self._chat_folder_cache[chat_id] = folder
         return folder
 
     def _sanitize_basename(self, name: str) -> str:
         base = Path(name).stem or "file"
-        sanitized = re.sub(r"[^A-Za-z0-9_\-]", "_", base)
+        sanitized = sanitizeName(base)
         sanitized = sanitized.strip("_") or "file"
         return sanitized[:80]
 
-    def _validate_extension(self, filename: str) -> str:
+    def _validate_extension(self, filename: str) -> tuple[str, frozenset[str]]:
+        # Retorna la extensión y los tipos MIME que acepta, con una sola
+        # búsqueda en el mapa.
         extension = Path(filename or "").suffix.lower()
-        if extension not in self.allowed_extensions:
+        allowed_mimes = self.allowed_extensions.get(extension)
+        if allowed_mimes is None:
             raise ValueError(
                 f"Extensión de archivo no permitida: {extension or 'sin extensión'}."
             )
-        return extension
+        return extension, allowed_mimes
 
-    def _normalize_mime(self, filename: str, content_type: str | None) -> str:
+    def _normalize_mime(self, extension: str, content_type: str | None) -> str:
         normalized = (content_type or "").lower().strip()
         if not normalized:
-            guessed, _ = mimetypes.guess_type(filename)
-            normalized = (guessed or "application/octet-stream").lower()
+            normalized = guessMimeType(extension)
         return normalized
 
-    def store_attachment(
-        self,
-        *,
-        chat_id: int,
-        sender_id: int,
-        filename: str,
-        payload: bytes,
-        content_type: str | None = None,
-    ) -> AttachmentInfo:
-        if not payload:
-            raise ValueError("El archivo está vacío.")
-        extension = self._validate_extension(filename)
-        mime_type = self._normalize_mime(filename, content_type)
-        allowed_mimes = self.allowed_extensions[extension]
+    def validate_attachment(self, filename: str, content_type: str | None = None) -> tuple[str, str]:
+        # Retorna (extensión, tipo MIME) o lanza ValueError si no se permiten.
+        extension, allowed_mimes = self._validate_extension(filename)
+        mime_type = self._normalize_mime(extension, content_type)
         if mime_type not in allowed_mimes:
             raise ValueError(
                 f"Tipo MIME '{mime_type}' no coincide con la extensión {extension}."
             )
+        return extension, mime_type
 
+    def _reserve_destination(self, chat_id: int, filename: str, extension: str) -> tuple[str, str]:
+        # La ruta destino se arma como texto: _coerce_target ya la dejó
+        # absoluta y normalizada, no hace falta otro Path ni resolve().
         folder = self._ensure_chat_folder(chat_id)
         basename = self._sanitize_basename(filename)
-        unique_name = f"{basename}-{uuid4().hex[:8]}{extension}"
-        destination = folder / unique_name
-
-        with destination.open("wb") as buffer:
-            buffer.write(payload)
+        unique_name = f"{basename}-{secrets.token_hex(4)}{extension}"
+        return os.path.join(folder, unique_name), unique_name
+
+    def _open_exclusive_destination(self, chat_id: int, filename: str, extension: str):
+        # "xb" abre con O_EXCL: si el nombre aleatorio ya existe se genera
+        # otro en lugar de sobrescribir un adjunto. Retorna (ruta, nombre,
+        # archivo abierto para escritura).
+        for _ in range(RESERVE_ATTEMPTS):
+            destination, unique_name = self._reserve_destination(chat_id, filename, extension)
+            try:
+                return destination, unique_name, open(destination, "xb")
+            except FileExistsError:
+                continue
+        raise FileExistsError("No se pudo reservar un nombre único para el adjunto.")
 
-        relative_path = str(Path(self.collection) / f"chat_{chat_id}" / unique_name)
+    def _build_attachment_info(
+        self,
+        *,
+        chat_id: int,
+        sender_id: int,
+        filename: str,
+        unique_name: str,
+        destination: str,
+        mime_type: str,
+        size_bytes: int,
+    ) -> AttachmentInfo:
+        relative_path = posixpath.join(self._collection_str, f"chat_{chat_id}", unique_name)
 
         return AttachmentInfo(
             chat_id=chat_id,
@@ -276,9 +560,85 @@ class ChatAttachmentManager(FileManager):
             original_filename=filename,
             stored_filename=unique_name,
             relative_path=relative_path,
-            absolute_path=str(destination.resolve()),
+            absolute_path=destination,
+            mime_type=mime_type,
+            size_bytes=size_bytes,
+        )
+
+    def store_attachment(
+        self,
+        *,
+        chat_id: int,
+        sender_id: int,
+        filename: str,
+        payload: bytes | BinaryIO,
+        content_type: str | None = None,
+    ) -> AttachmentInfo:
+        # payload puede ser bytes o un objeto tipo archivo; este último se
+        # copia por bloques sin materializarlo en memoria.
+        is_stream = hasattr(payload, "read")
+        if not is_stream and not payload:
+            raise ValueError("El archivo está vacío.")
+        extension, mime_type = self.validate_attachment(filename, content_type)
+        destination, unique_name, buffer = self._open_exclusive_destination(chat_id, filename, extension)
+
+        with buffer:
+            if is_stream:
+                shutil.copyfileobj(payload, buffer, COPY_CHUNK_SIZE)
+            else:
+                buffer.write(payload)
+            size_bytes = buffer.tell()
+        if not size_bytes:
+            os.unlink(destination)
+            raise ValueError("El archivo está vacío.")
+
+        return self._build_attachment_info(
+            chat_id=chat_id,
+            sender_id=sender_id,
+            filename=filename,
+            unique_name=unique_name,
+            destination=destination,
             mime_type=mime_type,
-            size_bytes=len(payload),
+            size_bytes=size_bytes,
+        )
+
+    def store_attachment_from_path(
+        self,
+        *,
+        chat_id: int,
+        sender_id: int,
+        filename: str,
+        source_path: str | Path,
+        content_type: str | None = None,
+    ) -> AttachmentInfo:
+        # Igual que store_attachment, pero mueve (rename) un archivo ya
+        # escrito en upload_folder() en lugar de recibir los bytes en memoria.
+        extension, mime_type = self.validate_attachment(filename, content_type)
+        size_bytes = os.stat(source_path).st_size
+        if not size_bytes:
+            raise ValueError("El archivo está vacío.")
+        # El nombre se reserva con un archivo vacío creado con O_EXCL y luego
+        # el rename lo reemplaza: nunca se sobrescribe otro adjunto.
+        destination, unique_name, placeholder = self._open_exclusive_destination(chat_id, filename, extension)
+        placeholder.close()
+        try:
+            # El temporal de la subida se crea con 0600; Nginx (X-Accel-Redirect)
+            # corre con otro usuario y necesita poder leer el adjunto.
+            os.chmod(source_path, 0o644)
+            os.replace(source_path, destination)
+        except BaseException:
+            with suppress(OSError):
+                os.unlink(destination)
+            raise
+
+        return self._build_attachment_info(
+            chat_id=chat_id,
+            sender_id=sender_id,
+            filename=filename,
+            unique_name=unique_name,
+            destination=destination,
+            mime_type=mime_type,
+            size_bytes=size_bytes,
         )
 
     def resolve_relative_path(self, relative_path: str) -> Path:
@@ -290,8 +650,13 @@ class ChatAttachmentManager(FileManager):
             target.unlink()
             parent = target.parent
             try:
-                if parent != self.root and parent.name.startswith("chat_") and not any(parent.iterdir()):
+                if parent != self.root and parent.name.startswith("chat_") and isFolderEmpty(parent):
                     parent.rmdir()
+                    # La carpeta ya no existe: se vuelve a crear en el
+                    # siguiente adjunto del chat.
+                    self._forget_resolved_dirs(os.path.relpath(parent, self._root_str))
+                    with suppress(ValueError):
+                        self._chat_folder_cache.pop(int(parent.name[len("chat_"):]), None)
             except OSError:
                 pass
 
@@ -334,14 +699,14 @@ class ProfileImage(FileManager):
         if ext not in self.allowed_formats:
             ext = self.default_extension
         base = Path(filename or "").stem
-        base = re.sub(r"[^A-Za-z0-9_\-]", "_", base).strip("_")
+        base = sanitizeName(base).strip("_")
         if not base:
             base = f"user_{user_id}" if user_id is not None else "profile"
-        unique_suffix = uuid4().hex[:12]
+        unique_suffix = secrets.token_hex(6)
         return f"{base[:80]}_{unique_suffix}{ext}"
 
-    def _build_relative_path(self, filename: str) -> Path:
-        return Path(self.collection) / filename
+    def _build_relative_path(self, filename: str) -> str:
+        return posixpath.join(self.collection, filename)
 
     def resolve_relative_path(self, relative_path: str) -> Path:
         if not relative_path:
@@ -359,6 +724,12 @@ class ProfileImage(FileManager):
         target.unlink()
         return True
 
+    async def delete_profile_image_async(self, relative_path: str, *, missing_ok: bool = True) -> bool:
+        # Igual que delete_profile_image, pero el unlink corre en un hilo.
+        return await asyncio.to_thread(
+            self.delete_profile_image, relative_path, missing_ok=missing_ok
+        )
+
     @contextmanager
     def _open_image(
         self, payload: bytes | bytearray | memoryview | io.BufferedIOBase | Path | str
@@ -386,16 +757,75 @@ class ProfileImage(FileManager):
                 handle.close()
 
     def _process_image(self, file_handle, size: int | tuple[int, int]) -> Image.Image:
+        if isinstance(size, int):
+            target_size = (size, size)
+        else:
+            target_size = size
         image = Image.open(file_handle)
+        # En JPEG, libjpeg decodifica directamente a 1/2, 1/4 u 1/8 del tamaño
+        # siempre que quede al menos al doble del destino; LANCZOS trabaja
+        # luego sobre menos píxeles. En otros formatos no hace nada.
+        with suppress(Exception):
+            image.draft("RGB", (target_size[0] * 2, target_size[1] * 2))
         image.load()
         if image.mode not in ("RGB", "RGBA"):
             image = image.convert("RGB")
-        if isinstance(size, int):
-            target_size = (size, size)
+        # Recorte centrado con la proporción del destino (lo mismo que
+        # ImageOps.fit) y redimensionado en un solo paso. Con reducing_gap
+        # Pillow reduce primero por bloques (BOX) y aplica LANCZOS sobre una
+        # imagen mucho más chica.
+        width, height = image.size
+        target_ratio = target_size[0] / target_size[1]
+        if width / height > target_ratio:
+            crop_width, crop_height = height * target_ratio, height
         else:
-            target_size = size
-        # Ajusta la imagen para que quede cuadrada sin distorsión.
-        return ImageOps.fit(image, target_size, Image.Resampling.LANCZOS, centering=(0.5, 0.5))
+            crop_width, crop_height = width, width / target_ratio
+        left = (width - crop_width) / 2
+        top = (height - crop_height) / 2
+        return image.resize(
+            target_size,
+            Image.Resampling.LANCZOS,
+            box=(left, top, left + crop_width, top + crop_height),
+            reducing_gap=RESIZE_REDUCING_GAP,
+        )
+
+    def _prepare_destination(
+        self,
+        payload,
+        *,
+        user_id: int | None,
+        filename: str | None,
+        overwrite: bool,
+    ) -> tuple[str, str, Path, str]:
+        # Retorna (nombre final, ruta relativa, ruta absoluta, formato de Pillow).
+        inferred_ext = self._infer_extension(filename) or self._infer_extension(
+            payload if isinstance(payload, (str, Path)) else None
+        )
+        final_filename = self._build_filename(user_id=user_id, extension=inferred_ext, filename=filename)
+        format_name = self.allowed_formats.get(os.path.splitext(final_filename)[1].lower(), self.allowed_formats[self.default_extension])
+
+        self._ensure_collection_folder()
+        relative_path = self._build_relative_path(final_filename)
+        destination = self._coerce_target(relative_path)
+        if destination.exists() and not overwrite:
+            raise FileExistsError(f"Ya existe un archivo en {destination}")
+        return final_filename, relative_path, destination, format_name
+
+    @staticmethod
+    def _save_image(image: Image.Image, destination, format_name: str) -> None:
+        # La conversión a RGB se hace solo aquí y solo para JPEG (que no
+        # admite canal alfa), ya sobre la imagen redimensionada.
+        if format_name == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(destination, format=format_name, **IMAGE_SAVE_OPTIONS.get(format_name, {}))
+
+    def _encode_profile_image(self, payload, size: int | tuple[int, int], format_name: str) -> bytes:
+        # Procesa la imagen y la codifica en memoria (sin tocar el disco).
+        buffer = io.BytesIO()
+        with self._open_image(payload) as source_image:
+            profile_image = self._process_image(source_image, size)
+            self._save_image(profile_image, buffer, format_name)
+        return buffer.getvalue()
 
     """
     API 
@@ -417,27 +847,50 @@ class ProfileImage(FileManager):
         self._ensure_pillow()
         size = size or self.target_size
 
-        inferred_ext = self._infer_extension(filename) or self._infer_extension(
-            payload if isinstance(payload, (str, Path)) else None
+        final_filename, relative_path, destination, format_name = self._prepare_destination(
+            payload, user_id=user_id, filename=filename, overwrite=overwrite
         )
-        final_filename = self._build_filename(user_id=user_id, extension=inferred_ext, filename=filename)
-        format_name = self.allowed_formats.get(Path(final_filename).suffix.lower(), self.allowed_formats[self.default_extension])
 
-        self._ensure_collection_folder()
-        relative_path = self._build_relative_path(final_filename)
-        destination = self._coerce_target(relative_path)
-        if destination.exists() and not overwrite:
-            raise FileExistsError(f"Ya existe un archivo en {destination}")
+        # Se codifica en memoria y se escribe con writeFileAtomic (O_NOFOLLOW)
+        # en lugar de que Pillow abra el destino directamente.
+        writeFileAtomic(destination, self._encode_profile_image(payload, size, format_name))
 
-        with self._open_image(payload) as source_image:
-            profile_image = self._process_image(source_image, size)
-            profile_image.save(destination, format=format_name)
+        return ProfileImageInfo(
+            user_id=user_id or -1,
+            filename=final_filename,
+            relative_path=relative_path,
+            absolute_path=str(destination),
+        )
+
+    async def createProfileImageAsync(
+        self,
+        payload: bytes | bytearray | memoryview | io.BufferedIOBase | Path | str,
+        *,
+        user_id: int | None = None,
+        filename: str | None = None,
+        size: int | tuple[int, int] | None = None,
+        overwrite: bool = False,
+    ) -> ProfileImageInfo:
+        # Versión para endpoints async de createProfileImage: el
+        # redimensionado (CPU) y la escritura en disco corren en hilos, así
+        # el event loop sigue atendiendo otras peticiones.
+        self._ensure_pillow()
+        size = size or self.target_size
+
+        final_filename, relative_path, destination, format_name = self._prepare_destination(
+            payload, user_id=user_id, filename=filename, overwrite=overwrite
+        )
+        loop = asyncio.get_running_loop()
+        encoded = await loop.run_in_executor(
+            IMAGE_POOL, self._encode_profile_image, payload, size, format_name
+        )
+        await asyncio.to_thread(writeFileAtomic, destination, encoded)
 
         return ProfileImageInfo(
             user_id=user_id or -1,
             filename=final_filename,
-            relative_path=relative_path.as_posix(),
-            absolute_path=str(destination.resolve()),
+            relative_path=relative_path,
+            absolute_path=str(destination),
         )
 
     pass